@@ -0,0 +1,134 @@
+import multiprocessing
+import queue
+import threading
+import traceback
+from time import time
+
+import ops
+import ops_dataset
+
+
+def prepare_batch(dataset, positions, symmetries, board_size, sparse_policy=False, timings=None):
+    # Gathered, expanded and augmented training batch: board planes, policies (move indices when sparse_policy),
+    # values and player turns. timings, when given, gets the seconds spent gathering and augmenting
+    t0 = time()
+    board_planes, policies, values, player_turn = ops_dataset.expand_batch(*dataset.gather(positions), board_size,
+                                                                           sparse_policy)
+    t1 = time()
+    board_planes, policies = ops.dihedral_batch(board_planes, policies, board_size, symmetries)
+    if timings is not None:
+        timings["gather"], timings["augmentation"] = t1 - t0, time() - t1
+    return board_planes, policies, values, player_turn
+
+
+class BatchPrefetcher:
+    """Prepares the training batches ahead of the training step.
+
+    ``workers`` threads, or processes when ``processes`` (forked, so the
+    dataset is shared instead of pickled), prepare the batches they are
+    given into a queue of at most ``queue_size`` batches. ``wait_time`` is
+    the time the trainer spent waiting on the queue during the last epoch,
+    ``last_timings`` the wait, gather and augmentation seconds of the last
+    batch yielded. With 0 workers the batches are prepared on demand. With
+    ``sparse_policy`` the policies are move indices. An epoch left before
+    its end stops being fed and its remaining batches are discarded by the
+    next one.
+    """
+
+    def __init__(self, dataset, board_size, workers=2, queue_size=8, processes=False, sparse_policy=False):
+        self.dataset = dataset
+        self.board_size = board_size
+        self.sparse_policy = sparse_policy
+        self.wait_time = 0.
+        self.last_timings = {}
+        self.epoch_number = 0
+        self.workers = []
+        if workers <= 0:
+            return
+        if processes:
+            context = multiprocessing.get_context("fork")
+            self.tasks, self.results = context.Queue(queue_size), context.Queue(queue_size)
+            self.workers = [context.Process(target=self._work, daemon=True) for _ in range(workers)]
+        else:
+            self.tasks, self.results = queue.Queue(queue_size), queue.Queue(queue_size)
+            self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            epoch_number, task = task
+            timings = {}
+            try:
+                result = ("batch", (prepare_batch(self.dataset, *task, self.board_size, self.sparse_policy, timings),
+                                    timings))
+            except Exception:
+                result = ("error", traceback.format_exc())
+            self.results.put((epoch_number,) + result)
+
+    def _feed(self, tasks, epoch_number):
+        count = 0
+        for task in tasks:
+            if self.epoch_number != epoch_number:
+                # A new epoch started
+                break
+            self.tasks.put((epoch_number, task))
+            count += 1
+        self.results.put((epoch_number, "done", count))
+
+    def epoch(self, tasks):
+        """
+        Yields the batches of an iterable of (positions, symmetries) tasks, symmetries being the idx of
+        ops.dihedral_batch (one for the batch or one per sample). With several workers the batches may come out
+        of order.
+        """
+        self.wait_time = 0.
+        self.epoch_number += 1
+        if not self.workers:
+            for task in tasks:
+                t0 = time()
+                timings = {}
+                batch = prepare_batch(self.dataset, *task, self.board_size, self.sparse_policy, timings)
+                timings["wait"] = time() - t0
+                self.wait_time += timings["wait"]
+                self.last_timings = timings
+                yield batch
+            return
+
+        feeder = threading.Thread(target=self._feed, args=(tasks, self.epoch_number), daemon=True)
+        feeder.start()
+        expected, received = None, 0
+        while expected is None or received < expected:
+            t0 = time()
+            epoch_number, kind, value = self.results.get()
+            wait = time() - t0
+            self.wait_time += wait
+            if epoch_number != self.epoch_number:
+                # Left over by an epoch the consumer stopped iterating
+                continue
+            if kind == "done":
+                expected = value
+            elif kind == "error":
+                raise RuntimeError("batch preparation failed:\n" + value)
+            else:
+                received += 1
+                batch, self.last_timings = value
+                self.last_timings["wait"] = wait
+                yield batch
+        feeder.join()
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        self.close()
@@ -0,0 +1,142 @@
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from time import time
+
+import numpy as np
+
+
+class BatchedEvaluator:
+    """Batches the network evaluations of concurrent callers.
+
+    Callers (self-play games, search workers, analysis jobs...) ``submit``
+    or ``evaluate`` positions from any thread. A single thread collects the
+    requests into one batch, which is evaluated by ``evaluate_fn`` once it
+    holds ``max_batch_size`` positions or ``timeout`` seconds after its
+    first request, and the rows of each result go back to their caller.
+
+    ``evaluate_fn`` takes batched arrays (the arrays of the requests
+    concatenated on the first axis) and returns an array or a tuple of
+    arrays with one row per position, e.g. GoNeuralNetwork.feed_forward.
+    ``stats`` gives the batch size histogram and the queueing latency.
+    Requests submitted after ``close`` raise a RuntimeError.
+    """
+
+    def __init__(self, evaluate_fn, max_batch_size=64, timeout=0.002, latency_window=100000):
+        self.evaluate_fn = evaluate_fn
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.requests = queue.Queue()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=latency_window)
+        self.run_time = 0.
+        self.closed = False
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def submit(self, *arrays):
+        """
+        Queues the evaluation of len(arrays[0]) positions.
+        :return: a concurrent.futures.Future of the result rows of these positions
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("submit on a closed BatchedEvaluator")
+            self.requests.put((arrays, future, time()))
+        return future
+
+    def evaluate(self, *arrays):
+        # Blocking submit
+        return self.submit(*arrays).result()
+
+    def _next_batch(self):
+        # The first request (waited for), then the ones arriving before the batch is full or the timeout expires
+        request = self.requests.get()
+        if request is None:
+            return None
+        batch, size = [request], len(request[0][0])
+        deadline = request[2] + self.timeout
+        while size < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(deadline - time(), 0.))
+            except queue.Empty:
+                break
+            if request is None:
+                # Evaluated before stopping
+                self.requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0][0])
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            t0 = time()
+            sizes = [len(arrays[0]) for arrays, _, _ in batch]
+            try:
+                inputs = [np.concatenate(arrays) for arrays in zip(*(arrays for arrays, _, _ in batch))]
+                results = self.evaluate_fn(*inputs)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            self.run_time += time() - t0
+            self.batch_sizes[sum(sizes)] += 1
+            self.latencies.extend(t0 - t_submit for _, _, t_submit in batch)
+
+            begin = 0
+            for (_, future, _), size in zip(batch, sizes):
+                if isinstance(results, (tuple, list)):
+                    future.set_result(tuple(result[begin:begin + size] for result in results))
+                else:
+                    future.set_result(results[begin:begin + size])
+                begin += size
+
+    def stats(self):
+        """
+        :return: dict with the number of batches and positions, the batch size histogram {size: batches}, the mean
+        batch size, the queueing latency (seconds from submit to the batch evaluation, over the last
+        latency_window requests) and the time spent in evaluate_fn
+        """
+        batches = sum(self.batch_sizes.values())
+        positions = sum(size * count for size, count in self.batch_sizes.items())
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {"batches": batches,
+                "positions": positions,
+                "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                "mean_batch_size": positions / max(batches, 1),
+                "queue_latency": {"mean": latencies.mean(),
+                                  "p50": np.percentile(latencies, 50),
+                                  "p90": np.percentile(latencies, 90),
+                                  "max": latencies.max()},
+                "run_time": self.run_time}
+
+    def print_stats(self):
+        stats = self.stats()
+        print("{} positions in {} batches (mean batch size {:.1f}), evaluation {:.3g} sec".format(
+            stats["positions"], stats["batches"], stats["mean_batch_size"], stats["run_time"]))
+        print("queue latency: mean {:.3g} ms, p50 {:.3g} ms, p90 {:.3g} ms, max {:.3g} ms".format(
+            *(stats["queue_latency"][key] * 1000 for key in ("mean", "p50", "p90", "max"))))
+        print("batch sizes  : " + ", ".join("{}: {}".format(size, count)
+                                           for size, count in stats["batch_size_histogram"].items()))
+
+    def close(self):
+        # Requests already queued are evaluated first
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.requests.put(None)
+        self.worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        self.close()
@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import ops
+
+
+class EvaluationCache:
+    """LRU cache of network evaluations in front of ``evaluate_fn``.
+
+    ``evaluate_fn`` maps input planes [N, size, size, planes] to policies
+    [N, size * size + 1] and values [N, 1] (GoNeuralNetwork.feed_forward,
+    BatchedEvaluator.evaluate, a Keras predict...). Positions are keyed by
+    the Zobrist hash of their planes (see ops.zobrist_hash), so a position
+    reached by another move order or in another game is a hit. The side to
+    move is part of the key through the player plane, or ``player_turn``.
+
+    With ``symmetric`` the key is the smallest hash of the 8 dihedral
+    transformations of the position and the policies are cached in that
+    orientation, then transformed back to the one of each query. The
+    planes are taken channels last, [N, size, size, planes], or
+    [N, planes, size, size] with ``channels_first`` (Keras encoders), and
+    any other shape is refused since its transformations would be wrong.
+
+    At most ``capacity`` evaluations are kept (about capacity * 4 *
+    (size * size + 2) bytes), the least recently used ones are evicted.
+    ``hits``, ``misses`` and ``evictions`` count over the cache lifetime.
+    """
+
+    def __init__(self, evaluate_fn, board_size, capacity=100000, symmetric=False, channels_first=False):
+        self.evaluate_fn = evaluate_fn
+        self.board_size = board_size
+        self.capacity = capacity
+        self.symmetric = symmetric
+        self.channels_first = channels_first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def _to_canonical(self, policies, idx):
+        # Policies of the queries to the orientation of their smallest hash (ops.dihedral_batch on the policies)
+        return policies[np.arange(len(policies))[:, None], ops.dihedral_policy_permutations(self.board_size)[idx]]
+
+    def evaluate(self, planes, player_turn=None):
+        """
+        :param planes: [N, size, size, planes] network inputs ([N, planes, size, size] with channels_first)
+        :param player_turn: [N] side to move, only needed when the planes do not hold it
+        :return: policies [N, size * size + 1] and values [N, 1], evaluate_fn only being run on the positions not
+        cached (once per distinct position)
+        """
+        planes = np.asarray(planes)
+        # Hashed channels last, the inputs of evaluate_fn stay as they are
+        board_planes = np.moveaxis(planes, 1, -1) if self.channels_first else planes
+        if self.symmetric and board_planes.shape[1:3] != (self.board_size, self.board_size):
+            raise ValueError("symmetric cache of {} planes, [N, {size}, {size}, planes] expected "
+                             "([N, planes, {size}, {size}] with channels_first)".format(planes.shape,
+                                                                                       size=self.board_size))
+        hashes, idx = ops.zobrist_hash(board_planes, self.board_size, player_turn, self.symmetric)
+        policies = np.empty((len(planes), self.board_size * self.board_size + 1), dtype=np.float32)
+        values = np.empty((len(planes), 1), dtype=np.float32)
+
+        missing = []
+        with self.lock:
+            for i, h in enumerate(hashes.tolist()):
+                entry = self.entries.get(h)
+                if entry is None:
+                    missing.append(i)
+                    continue
+                self.entries.move_to_end(h)
+                policies[i], values[i] = entry
+            self.hits += len(planes) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            # Each distinct missing position evaluated once
+            missing = np.array(missing)
+            _, first, group = np.unique(hashes[missing], return_index=True, return_inverse=True)
+            new_p, new_v = self.evaluate_fn(planes[missing[first]])
+            new_p, new_v = np.reshape(new_p, (len(first), -1)), np.reshape(new_v, (len(first), 1))
+            if self.symmetric:
+                new_p = self._to_canonical(new_p, idx[missing[first]])
+            policies[missing], values[missing] = new_p[group], new_v[group]
+            with self.lock:
+                for h, p, v in zip(hashes[missing[first]].tolist(), new_p, new_v):
+                    self.entries[h] = (p, v)
+                    self.entries.move_to_end(h)
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+        if self.symmetric:
+            # Back to the orientation of the queries
+            policies = ops.dihedral_inverse_policies(policies, self.board_size, idx)
+        return policies, values
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate(),
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "capacity": self.capacity}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -3,15 +3,23 @@ from libgoban import IGame
 
 import ops
 from Agent import Agent
-from GoNeuralNetwork import GoNeuralNetwork
+from GoNeuralNetwork import FrozenGoNeuralNetwork, GoNeuralNetwork
 
 
 class GoNNAgent(Agent):
 
-    def __init__(self, board_size):
+    def __init__(self, board_size, frozen_graph=None, cache_capacity=0, symmetric_cache=False):
+        # frozen_graph: play with the graph of GoNeuralNetwork.export_inference_graph, without learning
+        # cache_capacity: positions kept in the evaluation cache of the network (0: no cache), see
+        # GoNeuralNetwork.use_evaluation_cache
         print("--- Initialization of Go Agent")
         self.board_size = board_size
-        self.neural_network = GoNeuralNetwork(board_size)
+        if frozen_graph is not None:
+            self.neural_network = FrozenGoNeuralNetwork(board_size, frozen_graph)
+        else:
+            self.neural_network = GoNeuralNetwork(board_size)
+        if cache_capacity > 0:
+            self.neural_network.use_evaluation_cache(cache_capacity, symmetric_cache)
         self.g_old = np.full((1, board_size, board_size, 2), 0)
         print("Initialized - Agent")
 
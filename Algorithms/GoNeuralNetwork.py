@@ -2,8 +2,12 @@
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.client import timeline
 
 import ops
+import ops_tfdata
+from BatchedEvaluator import BatchedEvaluator
+from EvaluationCache import EvaluationCache
 from SarstReplayMemory import SarstReplayMemory
 
 #################################################
@@ -69,6 +73,8 @@ v_dense_size = 256
 
 # --- MCTS parameters ---
 c_puct = 4
+weak_mcts_batch_size = 512  # one-ply positions (times ensemble_symmetries) per evaluation
+ensemble_symmetries = 1  # dihedral symmetries averaged in the weak_mcts values (1: the position only, 8: all of them)
 
 # - Dirichlet noise
 dirichlet_alpha = 0.03
@@ -76,6 +82,7 @@ dirichlet_epsilon = 0.25
 
 # --- SaveFiles ---
 modelCheckpoint = "./modelWeights.ckpt"
+frozenGraphFile = "./frozenModel.pb"  # see export_inference_graph
 hyperparametersFile = "./modelParameters.gonn"
 memoryFile = "./modelMemory.gonn"
 
@@ -88,19 +95,18 @@ report_frequency = 1
 
 class GoNeuralNetwork:
 
-    def __init__(self, board_size, training_mode="reinforcement"):
+    def __init__(self, board_size, training_mode="reinforcement", sparse_policy=None):
         # training_mode = {"reinforcement", "supervised"}
+        # sparse_policy: policy targets are move indices (sparse softmax cross entropy) instead of distributions,
+        # by default in supervised training only (self-play targets are visit distributions)
 
         print("--- Initialization of Neural Network")
 
         # ----------------------------------------
         # Board size:
-        self.board_size = board_size
-        self.input_size = self.board_size * self.board_size
-        self.input_shape = [self.board_size, self.board_size, input_planes]
-        self.policy_size = self.input_size + 1
+        self.init_sizes(board_size)
+        self.sparse_policy = training_mode == "supervised" if sparse_policy is None else sparse_policy
 
-        self.network_inputs = {}
         self.memory_states = []
         self.memory_policies = []
         self.player_turns = []
@@ -108,6 +114,7 @@ class GoNeuralNetwork:
         self.total_iterations = 0
         self.temp_loss = 0
         self.total_games = 0
+        self.cache = None  # EvaluationCache of get_move and weak_mcts, see use_evaluation_cache
         
         if training_mode == "reinforcement":
             value_loss_weight = 1.
@@ -120,6 +127,13 @@ class GoNeuralNetwork:
         self.saver = tf.train.Saver()  # tf.all_variables()
         self.restore_model()
 
+    def init_sizes(self, board_size):
+        self.board_size = board_size
+        self.input_size = self.board_size * self.board_size
+        self.input_shape = [self.board_size, self.board_size, input_planes]
+        self.policy_size = self.input_size + 1
+        self.network_inputs = {}
+
     def init_network(self, tf_session):
         self.session = tf_session  # a tensorflow session
 
@@ -152,24 +166,26 @@ class GoNeuralNetwork:
         self.session.run(init_op)
 
     # This function will be used to build neural network
-    def build_network(self, scope_name):
+    def build_network(self, scope_name, inference=False):
+        # inference: graph of export_inference_graph, a float inputs placeholder only, no dropout and the batch norm
+        # folded into the conv weights
         net_shape = [None] + [s for s in self.input_shape]
         print(net_shape)
         with tf.variable_scope(scope_name):
-            self.is_train = tf.placeholder(tf.bool, name="is_train");
-            self.global_step = tf.placeholder(tf.int32, name="global_step")
-
-            # Input Layer
-            self.network_inputs[scope_name] = tf.placeholder(tf.float32, shape=net_shape, name="inputs")
+            if inference:
+                self.is_train = False
+                self.network_inputs[scope_name] = tf.placeholder(tf.float32, shape=net_shape, name="inputs")
+            else:
+                self.build_inputs(scope_name, net_shape)
 
             # Conv Layers "Tower"
             conv = ops.conv_layer(self.network_inputs[scope_name], filters, kernel_size, stride, activation,
-                                  "conv_first", useBatchNorm, drop_out, self.is_train, weight_initializer)
+                                  "conv_first", useBatchNorm, drop_out, self.is_train, weight_initializer, inference)
             #conv = tf.nn.pool(conv, window_shape=[2, 2], pooling_type="AVG", strides=[2, 2], padding='SAME')
             tower_input_size = int(conv.shape[1] * conv.shape[2])
             for i in range(num_blocks):
                 conv = ops.residual_conv_block(conv, filters, kernel_size, stride, activation, "conv" + str(i),
-                                               useBatchNorm, drop_out, self.is_train, weight_initializer)
+                                               useBatchNorm, drop_out, self.is_train, weight_initializer, inference)
 
             # Policy and value heads
             # - Compute conv output size
@@ -185,21 +201,48 @@ class GoNeuralNetwork:
 
             # - Policy head
             policy_conv = ops.conv_layer(conv, p_filters, p_kernel_size, p_stride, activation, "policy_conv",
-                                         useBatchNorm, drop_out, self.is_train, weight_initializer)
+                                         useBatchNorm, drop_out, self.is_train, weight_initializer, inference)
             policy_conv = ops.conv_layer(policy_conv, p_filters, p_kernel_size, p_stride, activation, "policy_conv2",
-                                         useBatchNorm, drop_out, self.is_train, weight_initializer)
+                                         useBatchNorm, drop_out, self.is_train, weight_initializer, inference)
             policy_conv = tf.contrib.layers.flatten(policy_conv)
             self.policy_out = ops.dense_layer(policy_conv, policy_shape, tf.identity, "policy", False, 0.0, self.is_train)
             self.policy_out_prob = p_activation(self.policy_out)
 
             # - Value head
             value_conv = ops.conv_layer(conv, v_filters, v_kernel_size, v_stride, activation, "value_conv",
-                                        useBatchNorm, drop_out, self.is_train, weight_initializer)
+                                        useBatchNorm, drop_out, self.is_train, weight_initializer, inference)
             value_conv = tf.contrib.layers.flatten(value_conv)
             value_out = ops.dense_layer(value_conv, value_shape, activation, "value", False, head_drop_out, self.is_train,
                                         weight_initializer=weight_initializer)
             self.value_out = ops.dense_layer(value_out, value_out_shape, v_activation, "value_out", False, 0.0, self.is_train)
 
+            if inference:
+                # Output names of the frozen graph
+                self.policy_out_prob = tf.identity(self.policy_out_prob, name="policy_prob")
+                self.value_out = tf.identity(self.value_out, name="value")
+
+    def build_inputs(self, scope_name, net_shape):
+        self.is_train = tf.placeholder(tf.bool, name="is_train");
+        self.global_step = tf.placeholder(tf.int32, name="global_step")
+
+        # Input Layer
+        # Fed batches by default, batches of the tf.data pipeline (see set_input_records) when nothing is fed
+        # uint8 board planes and a scalar turn per sample (see input_feed), cast and player plane in the graph
+        board_shape = [None, self.board_size, self.board_size, 4]
+        if self.sparse_policy:
+            target_p_type, target_p_shape = tf.int64, [None]
+        else:
+            target_p_type, target_p_shape = tf.float32, [None, self.policy_size]
+        self.input_iterator = tf.data.Iterator.from_structure(
+            (tf.uint8, tf.float32, target_p_type, tf.float32), (board_shape, [None], target_p_shape, [None, 1]))
+        self.pipeline_boards, self.pipeline_turns, self.pipeline_target_p, self.pipeline_target_v = \
+            self.input_iterator.get_next()
+        self.board_inputs = tf.placeholder_with_default(self.pipeline_boards, shape=board_shape,
+                                                        name="board_inputs")
+        self.turn_inputs = tf.placeholder_with_default(self.pipeline_turns, shape=[None], name="player_turn")
+        self.network_inputs[scope_name] = tf.placeholder_with_default(
+            ops.network_input(self.board_inputs, self.turn_inputs), shape=net_shape, name="inputs")
+
     # ----- Optimizer -----
     def _learning_rate_scheduling(self):
         if decay_learning_rate:
@@ -233,21 +276,37 @@ class GoNeuralNetwork:
         with tf.variable_scope('optimizer'):
             # Define placeholder
             # self.target_v = tf.placeholder(tf.float32, shape=[None], name="target_v")
-            self.target_v = tf.placeholder(tf.float32, shape=[None, 1], name="target_v")
-            self.target_p = tf.placeholder(tf.float32, shape=[None, self.policy_size], name="target_p")
+            self.target_v = tf.placeholder_with_default(self.pipeline_target_v, shape=[None, 1], name="target_v")
+            # - move indices (sparse_policy) or distributions, see target_feed
+            if self.sparse_policy:
+                self.target_p = tf.placeholder_with_default(self.pipeline_target_p, shape=[None], name="target_move")
+                self.target_move = self.target_p
+            else:
+                self.target_p = tf.placeholder_with_default(self.pipeline_target_p, shape=[None, self.policy_size],
+                                                            name="target_p")
+                self.target_move = tf.argmax(self.target_p, 1)
 
             # Loss
-            loss_v = tf.multiply(tf.reduce_mean(tf.square(tf.subtract(self.target_v, self.value_out))), value_loss_weight)
-            loss_p = tf.reduce_mean(
-                tf.nn.softmax_cross_entropy_with_logits_v2(labels=self.target_p, logits=self.policy_out))
+            # - per position, also summed chunk by chunk in evaluate
+            self.value_squared_error = tf.reduce_sum(tf.square(tf.subtract(self.target_v, self.value_out)), axis=1)
+            if self.sparse_policy:
+                self.policy_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.target_move,
+                                                                                  logits=self.policy_out)
+            else:
+                self.policy_loss = tf.nn.softmax_cross_entropy_with_logits_v2(labels=self.target_p,
+                                                                              logits=self.policy_out)
+            loss_v = tf.multiply(tf.reduce_mean(self.value_squared_error), value_loss_weight)
+            loss_p = tf.reduce_mean(self.policy_loss)
             self.loss_op = tf.add(loss_v, loss_p)
 
             # L2 regularization loss
+            self.l2_loss = tf.constant(0.)
             if l2_beta != 0.:
                 l2 = l2_beta * tf.add_n([tf.nn.l2_loss(v) for v in tf.trainable_variables()
                                          if not ("b_" in v.name)])
                 # self.loss_op = tf.add(self.loss_op, tf.reduce_mean(l2))
                 self.loss_op = tf.add(self.loss_op, l2)
+                self.l2_loss = l2
 
             # Learning rate scheduling
             self.learning_rate = self._learning_rate_scheduling()
@@ -262,8 +321,10 @@ class GoNeuralNetwork:
             self.optimizer = self._gradient_optimization(opt)
 
             # Accuracies
-            policy_correct_prediction = tf.equal(tf.argmax(self.policy_out_prob, 1), tf.argmax(self.target_p, 1))
-            self.policy_accuracy = tf.reduce_mean(tf.cast(policy_correct_prediction, "float"))
+            policy_correct_prediction = tf.equal(tf.argmax(self.policy_out_prob, 1), self.target_move)
+            self.policy_correct = tf.cast(policy_correct_prediction, "float")
+            self.policy_accuracy = tf.reduce_mean(self.policy_correct)
+            self.policy_top_k = {}
             self.value_accuracy = 1. - tf.reduce_mean(tf.abs(tf.subtract(self.target_v, self.value_out))) / 2.
             self.value_error = loss_v
 
@@ -284,46 +345,191 @@ class GoNeuralNetwork:
                 self.temp_loss = 0
                 self.save_model()
 
-    def train(self, state, target_p, target_v, global_step):
-        _, loss, p_acc, v_err = self.session.run(
+    def input_feed(self, state, player_turn=None):
+        """
+        feed_dict entries of a batch of network inputs.
+        :param state: [N, size, size, 5] float planes when player_turn is None, else the board planes only,
+        [N, size, size, 4] (uint8 or bool) or bit-packed [N, bytes] uint8 rows (ops_dataset.pack_states)
+        :param player_turn: [N] player turns, the player plane and the float cast are then done in the graph
+        """
+        if player_turn is None:
+            return {self.network_inputs['GoNeuralNetwork']: state}
+        if state.ndim == 2:
+            # Packed rows are unpacked on the host, the board input is a single placeholder
+            state = np.unpackbits(state, axis=1, count=self.board_size * self.board_size * 4)
+        return {self.board_inputs: np.reshape(state.view(np.uint8), [-1, self.board_size, self.board_size, 4]),
+                self.turn_inputs: player_turn}
+
+    def session_run(self, fetches, feed_dict, trace_file=None):
+        # session.run, traced when trace_file is given: the step timeline is written there in the Chrome trace
+        # format (chrome://tracing)
+        if trace_file is None:
+            return self.session.run(fetches, feed_dict)
+        run_metadata = tf.RunMetadata()
+        results = self.session.run(fetches, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                                   run_metadata=run_metadata)
+        with open(trace_file, "w") as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        return results
+
+    def target_feed(self, target_p):
+        # Policy targets, [N, size * size + 1] distributions or [N] move indices, as the network takes them
+        target_p = np.asarray(target_p)
+        if self.sparse_policy and target_p.ndim == 2:
+            target_p = np.argmax(target_p, axis=1)
+        elif not self.sparse_policy and target_p.ndim == 1:
+            target_p = np.eye(self.policy_size, dtype=np.float32)[target_p]
+        return target_p
+
+    def train(self, state, target_p, target_v, global_step, player_turn=None, trace_file=None):
+        feed_dict = self.input_feed(state, player_turn)
+        feed_dict.update({self.target_v: target_v,
+                          self.target_p: self.target_feed(target_p),
+                          self.is_train: True,
+                          self.global_step: global_step})
+        _, loss, p_acc, v_err = self.session_run(
+            [self.optimizer, self.loss_op, self.policy_accuracy, self.value_error], feed_dict, trace_file)
+        self.clear_cache()
+        return loss, p_acc, v_err
+
+    def set_input_records(self, files, batch_size, shuffle_buffer=50000, augment=True, prefetch=4):
+        # Points the tf.data pipeline to TFRecord shards written by ops_tfdata.export_records
+        dataset = ops_tfdata.records_dataset(files, self.board_size, batch_size, shuffle_buffer, augment, prefetch,
+                                             sparse_policy=self.sparse_policy)
+        self.session.run(self.input_iterator.make_initializer(dataset))
+
+    def train_from_pipeline(self, global_step, trace_file=None):
+        # Same as train on the next batch of the tf.data pipeline, no data goes through feed_dict
+        _, loss, p_acc, v_err = self.session_run(
             [self.optimizer, self.loss_op, self.policy_accuracy, self.value_error],
-            {self.network_inputs['GoNeuralNetwork']: state,
-             self.target_v: target_v,
-             self.target_p: target_p,
-             self.is_train: True,
+            {self.is_train: True,
              self.global_step: global_step
-             })
+             }, trace_file)
+        self.clear_cache()
         return loss, p_acc, v_err
 
     # ----- Feed Forward (without training) -----
-    def feed_forward(self, state):
-        p, v = self.session.run(
-            [self.policy_out_prob, self.value_out],
-            {self.network_inputs['GoNeuralNetwork']: state,
-             self.is_train: False,
-             self.global_step: self.total_iterations
-             })
+    def feed_forward(self, state, player_turn=None):
+        feed_dict = self.input_feed(state, player_turn)
+        feed_dict.update({self.is_train: False, self.global_step: self.total_iterations})
+        p, v = self.session.run([self.policy_out_prob, self.value_out], feed_dict)
         return p, v
 
-    def feed_forward_value(self, state):
-        v = self.session.run(
-            [self.value_out],
-            {self.network_inputs['GoNeuralNetwork']: state,
-             self.is_train: False,
-             self.global_step: self.total_iterations
-             })
+    def feed_forward_value(self, state, player_turn=None):
+        feed_dict = self.input_feed(state, player_turn)
+        feed_dict.update({self.is_train: False, self.global_step: self.total_iterations})
+        v = self.session.run([self.value_out], feed_dict)
         return v
 
-    def feed_forward_accuracies(self, state, target_p, target_v, global_step):
-        p_acc, v_err, p_out, v_out = self.session.run(
-            [self.policy_accuracy, self.value_error, self.policy_out_prob, self.value_out],
-            {self.network_inputs['GoNeuralNetwork']: state,
-             self.target_v: target_v,
-             self.target_p: target_p,
-             self.is_train: False,
-             self.global_step: global_step
-             })
-        return p_acc, v_err, p_out, v_out
+    def feed_forward_ensemble(self, state, num_symmetries=8, player_turn=None):
+        """
+        feed_forward averaged over dihedral symmetries: the num_symmetries transformations (all 8, or as many drawn
+        at random) of every position evaluated in one feed_forward, each policy mapped back to the orientation of its
+        position with the permutation tables of ops.
+        :param state: [N, size, size, planes], or board planes with player_turn (see input_feed)
+        :return: policies [N, size * size + 1] and values [N, 1], the means over the symmetries
+        """
+        if player_turn is not None and state.ndim == 2:
+            state = np.unpackbits(state, axis=1, count=self.board_size * self.board_size * 4)
+            state = np.reshape(state, [-1, self.board_size, self.board_size, 4])
+        n = len(state)
+        symmetries = np.arange(8) if num_symmetries >= 8 else np.random.choice(8, num_symmetries, replace=False)
+        symmetries = np.tile(symmetries, n)
+        states = np.repeat(state, len(symmetries) // n, axis=0)
+        states, _ = ops.dihedral_batch(states, None, self.board_size, symmetries)
+        p, v = self.feed_forward(states, None if player_turn is None else np.repeat(player_turn, len(symmetries) // n))
+        p = ops.dihedral_inverse_policies(p, self.board_size, symmetries)
+        return (np.mean(np.reshape(p, (n, -1, self.policy_size)), axis=1),
+                np.mean(np.reshape(v, (n, -1, 1)), axis=1))
+
+    def batched_evaluator(self, max_batch_size=64, timeout=0.002):
+        # feed_forward shared by concurrent callers, their positions evaluated together (see BatchedEvaluator)
+        return BatchedEvaluator(self.feed_forward, max_batch_size, timeout)
+
+    def evaluation_cache(self, capacity=100000, symmetric=False, evaluate_fn=None):
+        # feed_forward (or evaluate_fn, e.g. a batched_evaluator's evaluate) behind an LRU cache of positions, see
+        # EvaluationCache
+        return EvaluationCache(evaluate_fn or self.feed_forward, self.board_size, capacity, symmetric)
+
+    def use_evaluation_cache(self, capacity=100000, symmetric=False):
+        # get_move and weak_mcts evaluate their positions through an evaluation cache, cleared when the weights change
+        self.cache = self.evaluation_cache(capacity, symmetric, self._evaluate)
+        return self.cache
+
+    def _evaluate(self, state):
+        # feed_forward averaged over ensemble_symmetries dihedral symmetries when above 1
+        if ensemble_symmetries > 1:
+            return self.feed_forward_ensemble(state, ensemble_symmetries)
+        return self.feed_forward(state)
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    def evaluate_positions(self, state):
+        # feed_forward of get_move, through the evaluation cache when used
+        return self.feed_forward(state) if self.cache is None else self.cache.evaluate(state)
+
+    def evaluate_values(self, state):
+        # Values of the weak_mcts positions, averaged over ensemble_symmetries symmetries when above 1, through the
+        # evaluation cache when used
+        if self.cache is not None:
+            return self.cache.evaluate(state)[1]
+        if ensemble_symmetries > 1:
+            return self.feed_forward_ensemble(state, ensemble_symmetries)[1]
+        return self.feed_forward_value(state)[0]
+
+    def feed_forward_accuracies(self, state, target_p, target_v, global_step, chunk_size=1024):
+        # Same results as a single session.run, the set going through the network chunk_size positions at a time
+        p_acc, v_err, p_out, v_out = 0., 0., [], []
+        for b in range(0, len(state), chunk_size):
+            c_p_acc, c_v_err, c_p_out, c_v_out = self.session.run(
+                [self.policy_accuracy, self.value_error, self.policy_out_prob, self.value_out],
+                {self.network_inputs['GoNeuralNetwork']: state[b:b + chunk_size],
+                 self.target_v: target_v[b:b + chunk_size],
+                 self.target_p: self.target_feed(target_p[b:b + chunk_size]),
+                 self.is_train: False,
+                 self.global_step: global_step
+                 })
+            weight = len(c_v_out) / len(state)
+            p_acc, v_err = p_acc + c_p_acc * weight, v_err + c_v_err * weight
+            p_out.append(c_p_out)
+            v_out.append(c_v_out)
+        return p_acc, v_err, np.concatenate(p_out), np.concatenate(v_out)
+
+    def _policy_top_k(self, k):
+        if k not in self.policy_top_k:
+            self.policy_top_k[k] = tf.cast(tf.nn.in_top_k(self.policy_out, self.target_move, k), "float")
+        return self.policy_top_k[k]
+
+    def evaluate(self, batches, global_step, top_k=()):
+        """
+        Streams an evaluation set through the network, memory only depends on the size of the batches.
+        :param batches: iterable of (states, target_p, target_v) or (states, target_p, target_v, player_turn) chunks,
+        see input_feed and target_feed
+        :param top_k: k of the top-k policy accuracies to compute as well
+        :return: dict with the exact policy_accuracy, value_error and loss over the whole set, top_k {k: accuracy}
+        and positions
+        """
+        fetches = [self.policy_correct, self.value_squared_error, self.policy_loss] + \
+                  [self._policy_top_k(k) for k in top_k]
+        sums, positions = np.zeros(len(fetches)), 0
+        for state, target_p, target_v, *player_turn in batches:
+            feed_dict = self.input_feed(state, *player_turn)
+            feed_dict.update({self.target_v: target_v,
+                              self.target_p: self.target_feed(target_p),
+                              self.is_train: False,
+                              self.global_step: global_step})
+            results = self.session.run(fetches, feed_dict)
+            sums += [np.sum(result) for result in results]
+            positions += len(state)
+        means = sums / max(positions, 1)
+        value_error = means[1] * value_loss_weight
+        return {"policy_accuracy": means[0],
+                "value_error": value_error,
+                "loss": value_error + means[2] + self.session.run(self.l2_loss),
+                "top_k": dict(zip(top_k, means[3:])),
+                "positions": positions}
 
     # ----- Policy Improvement Operators -----
     def remove_illegal(self, legals, p):
@@ -347,21 +553,21 @@ class GoNeuralNetwork:
         planes[:, :, :, 0] = planes[:, :, :, 1]
         planes[:, :, :, 1] = tmp
 
-        # Simulates the legal move and get value
-        for move in legals:
-            # planes[0][move[0]][move[1]][0] = player_turn+1
-            last_plane = int(input_planes - 1 - num_boards)
-            planes[0][move[0]][move[1]][last_plane] = 1
-            t_v = self.feed_forward_value(planes)
-            planes[0][move[0]][move[1]][last_plane] = 0
-            s_move = move[0] * self.board_size + move[1]
-            t_v = t_v[0][0][0]
-            new_p[0][s_move] = (t_v * (-1.) + 2.)  # + p[0][s_move]
-
-        # Simulates pass move and get value
-        t_v = self.feed_forward_value(planes)
-        t_v = t_v[0][0][0]
-        new_p[0][self.input_size] = (t_v * (-1.) + 2.)  # + p[0][self.input_size]
+        # Simulates the legal moves and the pass move, all the next positions [L + 1, size, size, planes] evaluated
+        # in batches of weak_mcts_batch_size network inputs
+        last_plane = int(input_planes - 1 - num_boards)
+        rows = np.array([move[0] for move in legals], dtype=int)
+        cols = np.array([move[1] for move in legals], dtype=int)
+        candidates = np.repeat(planes[:1], len(legals) + 1, axis=0)
+        # Every position sees the points of the moves simulated before it cleared (pass sees them all)
+        after, before = np.nonzero(np.tri(len(legals) + 1, len(legals), -1, dtype=bool))
+        candidates[after, rows[before], cols[before], last_plane] = 0
+        candidates[np.arange(len(legals)), rows, cols, last_plane] = 1
+        chunk_size = max(1, weak_mcts_batch_size // ensemble_symmetries)
+        t_v = np.concatenate([self.evaluate_values(candidates[b:b + chunk_size])[:, 0]
+                              for b in range(0, len(candidates), chunk_size)])
+        new_p[0][rows * self.board_size + cols] = (t_v[:-1] * (-1.) + 2.)  # + p[0][s_move]
+        new_p[0][self.input_size] = (t_v[-1] * (-1.) + 2.)  # + p[0][self.input_size]
 
         # Dirichlet noise
         new_p[0] = ops.dirichlet_noise(new_p[0], dirichlet_alpha, dirichlet_epsilon)
@@ -373,8 +579,7 @@ class GoNeuralNetwork:
 
     def get_move(self, planes, player_turn, legals):
         self.run_minibatch()
-        # TODO - Dihedral Transformation on planes (and reverse transformation for p)
-        p, v = self.feed_forward(planes)
+        p, v = self.evaluate_positions(planes)
 
         # Policy Improvement Operator
         # TODO - (real) MCTS policy improvement
@@ -440,6 +645,7 @@ class GoNeuralNetwork:
         if (tf.train.checkpoint_exists("checkpoint")):
             # Restore model
             self.saver.restore(self.session, modelCheckpoint)
+            self.clear_cache()
             print("\n=== Model restored from \"{}\" ===".format(modelCheckpoint))
             # Restore memory
             self.restore_memory(memoryFile)
@@ -453,6 +659,28 @@ class GoNeuralNetwork:
     def restore_memory(self, memoryFile):
         self.replay_memory.restore_memory(memoryFile)
 
+    @classmethod
+    def export_inference_graph(cls, board_size, out_file=frozenGraphFile, checkpoint=modelCheckpoint):
+        """
+        Writes the frozen inference graph of a checkpoint, loaded by FrozenGoNeuralNetwork: batch norm folded into
+        the conv weights, no dropout, optimizer nor is_train, weights as constants. Input "GoNeuralNetwork/inputs"
+        [N, size, size, input_planes], outputs "GoNeuralNetwork/policy_prob" and "GoNeuralNetwork/value".
+        """
+        network = cls.__new__(cls)
+        network.init_sizes(board_size)
+        graph = tf.Graph()
+        with graph.as_default(), tf.Session(graph=graph) as session:
+            network.build_network('GoNeuralNetwork', inference=True)
+            tf.train.Saver().restore(session, checkpoint)
+            session.run(tf.get_collection(ops.FOLDED_BATCH_NORM))
+            outputs = [network.policy_out_prob.op.name, network.value_out.op.name]
+            graph_def = tf.graph_util.convert_variables_to_constants(session, graph.as_graph_def(), outputs)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=outputs)
+        with tf.gfile.GFile(out_file, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        print("=== Inference graph of \"{}\" saved as \"{}\" ({} nodes) ===".format(checkpoint, out_file,
+                                                                                len(graph_def.node)))
+
     #################################################
     # Getter and Setter
     #################################################
@@ -461,3 +689,54 @@ class GoNeuralNetwork:
         
     def get_number_of_parameters(self):
         return np.sum([np.prod(v.shape) for v in tf.trainable_variables()])
+
+
+class FrozenGoNeuralNetwork(GoNeuralNetwork):
+    """Inference only GoNeuralNetwork, loaded from a graph written by
+    GoNeuralNetwork.export_inference_graph.
+
+    Plays like GoNeuralNetwork (feed_forward, weak_mcts, get_move) without
+    building the training graph, the replay memory nor restoring a
+    checkpoint. Nothing is learnt from its games.
+    """
+
+    def __init__(self, board_size, graph_file=frozenGraphFile):
+        print("--- Loading of the frozen Neural Network \"{}\"".format(graph_file))
+        self.init_sizes(board_size)
+        self.total_iterations = 0
+        self.cache = None
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_file, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=graph)
+        self.network_inputs['GoNeuralNetwork'] = graph.get_tensor_by_name("GoNeuralNetwork/inputs:0")
+        self.policy_out_prob = graph.get_tensor_by_name("GoNeuralNetwork/policy_prob:0")
+        self.value_out = graph.get_tensor_by_name("GoNeuralNetwork/value:0")
+
+    def feed_forward(self, state, player_turn=None):
+        return self.session.run([self.policy_out_prob, self.value_out], self.input_feed(state, player_turn))
+
+    def feed_forward_value(self, state, player_turn=None):
+        return self.session.run([self.value_out], self.input_feed(state, player_turn))
+
+    def input_feed(self, state, player_turn=None):
+        # Float input planes only, board planes and player turns (see GoNeuralNetwork.input_feed) are expanded on the
+        # host
+        if player_turn is not None:
+            if state.ndim == 2:
+                state = np.unpackbits(state, axis=1, count=self.board_size * self.board_size * 4)
+            state = np.reshape(state, [-1, 1, self.board_size, self.board_size, 4]).astype(np.float32)
+            state = ops.add_player_feature_planes(state, self.board_size, player_turn)[:, 0]
+        return {self.network_inputs['GoNeuralNetwork']: state}
+
+    def get_move(self, planes, player_turn, legals):
+        p, v = self.evaluate_positions(planes)
+        p = self.weak_mcts(planes, player_turn, legals, p)
+        return p, v
+
+    def save_in_replay_memory(self, winner):
+        pass
+
@@ -0,0 +1,87 @@
+import json
+from contextlib import contextmanager
+from time import time
+
+import numpy as np
+
+
+class StepProfiler:
+    """Where the time of the training steps goes.
+
+    Each step records the seconds spent in named stages (``add`` or the
+    ``stage`` context manager), the step time being the time since the end
+    of the previous step (or ``start``), so waiting on the next batch is
+    included. Every ``summary_frequency`` steps the mean, median, 90th
+    percentile, max and share of the step time of each stage over these
+    steps is appended as one JSON line to ``out_file`` (None to keep no
+    summaries). Every ``trace_frequency`` steps (0 for never) ``trace_file``
+    names the Chrome trace file of the step (see GoNeuralNetwork.train).
+    """
+
+    def __init__(self, out_file="training_profile.jsonl", summary_frequency=100, trace_frequency=0,
+                 trace_prefix="timeline"):
+        self.out_file = out_file
+        self.summary_frequency = summary_frequency
+        self.trace_frequency = trace_frequency
+        self.trace_prefix = trace_prefix
+        self.window, self.traces = [], []
+        self.current, self.last_step = {}, 0
+        self.t_step = time()
+
+    def start(self):
+        # Time outside of the steps (evaluation, saving...) is not counted
+        self.current = {}
+        self.t_step = time()
+
+    def add(self, stage, seconds):
+        self.current[stage] = self.current.get(stage, 0.) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time()
+        yield
+        self.add(name, time() - t0)
+
+    def trace_file(self, step):
+        if self.trace_frequency <= 0 or step % self.trace_frequency != 0:
+            return None
+        self.traces.append("{}-{:08d}.json".format(self.trace_prefix, step))
+        return self.traces[-1]
+
+    def end_step(self, step):
+        t = time()
+        self.current["step"] = t - self.t_step
+        self.window.append(self.current)
+        self.current, self.t_step, self.last_step = {}, t, step
+        if len(self.window) >= self.summary_frequency:
+            self.write_summary()
+
+    def summary(self):
+        step_time = sum(timings["step"] for timings in self.window)
+        stages = {}
+        for stage in sorted({stage for timings in self.window for stage in timings}):
+            seconds = np.array([timings.get(stage, 0.) for timings in self.window])
+            stages[stage] = {"mean": seconds.mean(),
+                             "p50": np.percentile(seconds, 50),
+                             "p90": np.percentile(seconds, 90),
+                             "max": seconds.max(),
+                             "share": seconds.sum() / step_time if step_time > 0 else 0.}
+        return {"step": self.last_step,
+                "steps": len(self.window),
+                "time": time(),
+                "steps_per_sec": len(self.window) / step_time if step_time > 0 else 0.,
+                "traces": self.traces,
+                "stages": stages}
+
+    def write_summary(self):
+        if not self.window:
+            return None
+        summary = self.summary()
+        if self.out_file is not None:
+            with open(self.out_file, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+        self.window, self.traces = [], []
+        return summary
+
+    def close(self):
+        return self.write_summary()
@@ -92,9 +92,11 @@ class ZeroTreeNode:
 
 
 class ZeroAgent(Agent):
-    def __init__(self, model, encoder, rounds_per_move=1600, c=2.0):
+    def __init__(self, model, encoder, rounds_per_move=1600, c=2.0, cache=None):
+        # cache: EvaluationCache over model.predict, shared by the nodes of every search
         self.model = model
         self.encoder = encoder
+        self.cache = cache
 
         self.collector = None
 
@@ -155,7 +157,10 @@ class ZeroAgent(Agent):
     def create_node(self, game_state, move=None, parent=None):
         state_tensor = self.encoder.encode(game_state)
         model_input = np.array([state_tensor])  # <1>
-        priors, values = self.model.predict(model_input)
+        if self.cache is not None:
+            priors, values = self.cache.evaluate(model_input)
+        else:
+            priors, values = self.model.predict(model_input)
         priors = priors[0]  # <2>
         value = values[0][0]  # <2>
         move_priors = {  # <3>
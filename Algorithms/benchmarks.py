@@ -0,0 +1,211 @@
+import json
+import os
+import resource
+import shutil
+import tempfile
+from multiprocessing import get_context
+from time import time
+
+import numpy as np
+from libgoban import IGame
+
+import ops
+
+from ops_dataset import MOVE_PLAYER_BIT, DatasetWriter, consolidate_chunks, replay_positions, save_games
+from ops_sgf import (SGF_file_read, SGF_file_to_game, SGF_files_to_dataset, SGF_folder_files, SGF_legacy_tokens,
+                     SGF_parse)
+
+
+def best_time(function, args, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time()
+        for arg in args:
+            function(arg)
+        best = min(best, time() - t0)
+    return best
+
+
+# ------------------------------------------
+# --------------- SGF parser ---------------
+# ------------------------------------------
+
+def _legacy_header_and_moves(content):
+    # SGF_legacy_tokens followed by the linear token scan SGF_file_to_dataset used to do
+    content = SGF_legacy_tokens(content)
+    header, moves = {}, []
+    for i in range(len(content)):
+        elem = content[i]
+        if elem == "SZ" or elem == "HA" or elem == "KM" or elem == "RE" or elem == "RU":
+            header[elem] = [content[i + 1]]
+        elif elem == "W" or elem == "B":
+            moves.append(elem + content[i + 1])
+    return header, moves
+
+
+def bench_sgf_parser(folder_name, num_files=0, repeat=5):
+    file_names = SGF_folder_files(folder_name)
+    if num_files > 0:
+        file_names = file_names[:num_files]
+
+    # Files are read once, only parsing is timed
+    t0 = time()
+    contents = []
+    for file_name in file_names:
+        with open(file_name, "r", encoding="utf-8", errors="replace") as fichier:
+            contents.append(fichier.read())
+    read = time() - t0
+
+    legacy = best_time(_legacy_header_and_moves, contents, repeat)
+    tokenizer = best_time(SGF_parse, contents, repeat)
+
+    print("{} files, read in {:.3f} sec (parsing: best of {})".format(len(file_names), read, repeat))
+    print("legacy parser : {:.3f} sec ({:.0f} files/sec)".format(legacy, len(file_names) / legacy))
+    print("tokenizer     : {:.3f} sec ({:.0f} files/sec)".format(tokenizer, len(file_names) / tokenizer))
+    print("speedup       : {:.1f}x".format(legacy / tokenizer))
+    return {"files": len(file_names), "read": read, "legacy": legacy, "tokenizer": tokenizer}
+
+
+# ------------------------------------------
+# ------------- Preprocessing --------------
+# ------------------------------------------
+
+def peak_rss():
+    # Peak resident set size of the process, in MB (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _stage_parse(file_names, out):
+    return sum(len(SGF_file_read(file_name)[1]) for file_name in file_names), None
+
+
+def _stage_replay(file_names, out):
+    # Board updates only, no feature planes
+    positions = 0
+    for file_name in file_names:
+        size, _, _, setup, moves = SGF_file_to_game(file_name)
+        g = IGame(size)
+        for move in setup + [move & (MOVE_PLAYER_BIT - 1) for move in moves]:
+            g.play(None if move == size * size else (move // size, move % size))
+        positions += len(moves)
+    return positions, None
+
+
+def _stage_features(file_names, out):
+    positions = 0
+    for file_name in file_names:
+        size, _, _, setup, moves = SGF_file_to_game(file_name)
+        positions += len(replay_positions(size, setup, moves))
+    return positions, None
+
+
+def _stage_save(file_names, out, compact):
+    writer = DatasetWriter(out + "bench", compact=compact)
+    chunk_files = SGF_files_to_dataset(file_names, writer, verbose=False)
+    consolidate_chunks(chunk_files, out + "dataset.npz")
+    return writer.num_positions, os.path.getsize(out + "dataset.npz")
+
+
+def _stage_save_dense(file_names, out):
+    return _stage_save(file_names, out, False)
+
+
+def _stage_save_compact(file_names, out):
+    return _stage_save(file_names, out, True)
+
+
+def _stage_save_move_list(file_names, out):
+    games = list(map(SGF_file_to_game, file_names))
+    save_games(games, out + "games.npz")
+    return sum(len(game[4]) for game in games), os.path.getsize(out + "games.npz")
+
+
+PREPROCESSING_STAGES = {"parse": _stage_parse,
+                        "replay": _stage_replay,
+                        "features": _stage_features,
+                        "save-dense": _stage_save_dense,
+                        "save-compact": _stage_save_compact,
+                        "save-move-list": _stage_save_move_list}
+
+
+def _run_stage(stage, file_names):
+    # Runs in a fresh process so that the peak RSS is the one of this stage
+    out = tempfile.mkdtemp(prefix="bench_") + "/"
+    try:
+        rss = peak_rss()
+        t0 = time()
+        positions, size = PREPROCESSING_STAGES[stage](file_names, out)
+        elapsed = time() - t0
+    finally:
+        shutil.rmtree(out)
+    result = {"seconds": elapsed,
+              "games_per_sec": len(file_names) / elapsed,
+              "positions": positions,
+              "positions_per_sec": positions / elapsed,
+              "peak_rss_mb": peak_rss(),
+              "stage_rss_mb": peak_rss() - rss}
+    if size is not None:
+        result["bytes"] = size
+        result["bytes_per_position"] = size / max(positions, 1)
+    return result
+
+
+def bench_preprocessing(folder_name, num_files=200, out_file="bench_preprocessing.json", stages=None):
+    """
+    Runs the preprocessing stages on the first num_files games of folder_name, each in its own process, and writes
+    games/sec, positions/sec, bytes per position (for the stages writing a dataset) and peak RSS to out_file.
+    The save stages run the whole pipeline (parse, replay, features and save).
+    """
+    file_names = SGF_folder_files(folder_name)
+    if num_files > 0:
+        file_names = file_names[:num_files]
+    stages = stages or list(PREPROCESSING_STAGES)
+
+    results = {"folder": os.path.abspath(folder_name), "files": len(file_names), "stages": {}}
+    ctx = get_context("spawn")
+    print("{:<16}{:>10}{:>12}{:>14}{:>12}{:>14}".format("stage", "sec", "games/s", "positions/s", "bytes/pos",
+                                                       "peak RSS MB"))
+    for stage in stages:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(_run_stage, (stage, file_names))
+        results["stages"][stage] = result
+        print("{:<16}{:>10.3f}{:>12.1f}{:>14.0f}{:>12}{:>14.1f}".format(
+            stage, result["seconds"], result["games_per_sec"], result["positions_per_sec"],
+            "{:.1f}".format(result["bytes_per_position"]) if "bytes_per_position" in result else "-",
+            result["peak_rss_mb"]))
+
+    with open(out_file, "w") as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+# ------------------------------------------
+# -------------- Augmentation --------------
+# ------------------------------------------
+
+def bench_augmentation(batch_size=32, board_size=19, input_planes=5, repeat=20):
+    states = np.random.randint(0, 2, (batch_size, board_size, board_size, input_planes)).astype(np.float32)
+    policies = np.random.rand(batch_size, board_size * board_size + 1)
+    values = np.random.rand(batch_size, 1)
+    symmetries = np.random.randint(0, 8, batch_size)
+
+    cases = [("one symmetry", 3, 3), ("all 8 symmetries", None, None), ("per-sample symmetry", symmetries, None)]
+    results = {}
+    print("batch of {} {}x{}x{} (best of {})".format(batch_size, board_size, board_size, input_planes, repeat))
+    for name, idx, legacy_idx in cases:
+        batched = best_time(lambda _: ops.data_augmentation(states, policies, values, board_size, input_planes, idx),
+                            [None], repeat)
+        if legacy_idx is None and idx is not None:
+            # The legacy path takes one idx for the whole batch, one call per sample
+            def legacy(_):
+                for i in range(batch_size):
+                    ops.data_augmentation_legacy(states[i:i + 1], policies[i:i + 1], values[i:i + 1], board_size,
+                                                 input_planes, symmetries[i])
+        else:
+            def legacy(_):
+                ops.data_augmentation_legacy(states, policies, values, board_size, input_planes, legacy_idx)
+        legacy = best_time(legacy, [None], repeat)
+        print("{:<20}: legacy {:.2f} ms, batched {:.3f} ms ({:.0f}x)".format(name, legacy * 1000, batched * 1000,
+                                                                            legacy / batched))
+        results[name] = {"legacy": legacy, "batched": batched}
+    return results
@@ -11,16 +11,80 @@ def cli(verbose):
 @cli.command()
 @click.argument("path", type=click.Path(exists=True))
 @click.option("-o", "--output", type=click.Path(), default="np_datasets/")
-def prepros(path, output):
-    from ops import SGF_folder_to_dataset
+@click.option("-w", "--workers", default=1, help="Number of processes parsing the SGF files")
+@click.option("--chunk-size", default=50000, help="Positions held in memory before being flushed to disk")
+@click.option("--compact", is_flag=True, default=False, help="Bit-packed states and move indices instead of one-hot policies")
+@click.option("--shard-files", default=1000, help="Games per shard, the unit of incremental and resumed runs")
+@click.option("--hash", "use_hash", is_flag=True, default=False, help="Also identify processed files by content hash")
+@click.option("--dedup", type=click.Choice(["drop", "merge"]), default=None,
+              help="Remove repeated positions (symmetries included): drop the repeats or merge them into one row")
+@click.option("--include", type=click.Path(exists=True), default=None,
+              help="Include list written by the filter command, only its games are parsed")
+@click.option("--move-list", is_flag=True, default=False,
+              help="Store the move sequence of each game (games.npz), positions are replayed at training time")
+def prepros(path, output, workers, chunk_size, compact, shard_files, use_hash, dedup, include, move_list):
+    from ops_sgf import SGF_archive_to_dataset, SGF_folder_to_dataset, SGF_folder_to_games, SGF_is_archive
     import os
+    if SGF_is_archive(path) and (include is not None or use_hash):
+        raise click.UsageError("--include and --hash only apply to folders, not to archives")
     if not os.path.exists(output):
         os.mkdir(output)
-    # SGF_folder_rule_filter(sys.argv[1], "Chinese")
-    SGF_folder_to_dataset(path, output)
+    if move_list:
+        SGF_folder_to_games(path, output, workers=workers, include=include)
+        return
+    if SGF_is_archive(path):
+        SGF_archive_to_dataset(path, output, workers=workers, chunk_size=chunk_size, compact=compact,
+                               shard_files=shard_files, dedup=dedup)
+        return
+    SGF_folder_to_dataset(path, output, workers=workers, chunk_size=chunk_size, compact=compact,
+                          shard_files=shard_files, use_hash=use_hash, dedup=dedup, include=include)
     # SGF_file_to_dataset(sys.argv[1])
 
 
+@cli.command("filter")
+@click.argument("path", type=click.Path(exists=True))
+@click.option("-r", "--rule", default="Chinese", help="Value of the RU property of the games to keep")
+@click.option("-o", "--output", type=click.Path(), default="include.json")
+@click.option("-w", "--workers", default=1, help="Number of processes reading the SGF headers")
+def rule_filter(path, rule, output, workers):
+    from ops_sgf import SGF_folder_rule_filter
+    SGF_folder_rule_filter(path, rule, output, workers=workers)
+
+
+def self_play_game(go_agent, board_size, game):
+    # One game of go_agent against itself, returns the winner (2 for a draw)
+    import ops
+    from libgoban import IGame
+    turn_max = int(board_size ** 2 * 2.)
+
+    g = IGame(board_size)
+    g.display_goban()
+
+    total_turn = 0
+    while not g.over():
+        print("game {} - total_turn = {}".format(game, total_turn))
+
+        move = go_agent.select_move(g)
+        t_move = ops.move_scalar_to_tuple(move, board_size)
+        if t_move in g.legals():
+            print(t_move)
+            g.play(t_move)
+        else:
+            print("play pass")
+            g.play(None)
+        g.display_goban()
+        total_turn += 1
+        if total_turn > turn_max:
+            break
+
+    if total_turn > turn_max:
+        print("(Draw due to maximum moves)")
+        return 2
+    score = g.outcome()
+    print(score)
+    return 2 if score[0] == score[1] else 0 if score[0] > score[1] else 1
+
+
 @cli.group()
 def learn():
     pass
@@ -28,44 +92,46 @@ def learn():
 
 @learn.command()
 @click.option("-s", "--board-size", type=click.Choice(["9", "13", "19"]), default="13")
-def reinforcement(board_size):
-    import ops
+@click.option("--cache-size", default=0, help="Positions kept in the evaluation cache (0 for no cache)")
+def reinforcement(board_size, cache_size):
     from GoNNAgent import GoNNAgent
-    from libgoban import IGame
     # Reinforcement training
     board_size = int(board_size)
-    go_agent = GoNNAgent(board_size)
-    turn_max = int(board_size ** 2 * 2.)
+    go_agent = GoNNAgent(board_size, cache_capacity=cache_size)
     for i in range(1000):
+        winner = self_play_game(go_agent, board_size, i)
+        go_agent.end_game(winner)
 
-        g = IGame(board_size)
-        g.display_goban()
 
-        total_turn = 0
-        while not g.over():
-            print("game {} - total_turn = {}".format(i, total_turn))
-
-            move = go_agent.select_move(g)
-            t_move = ops.move_scalar_to_tuple(move, board_size)
-            if t_move in g.legals():
-                print(t_move)
-                g.play(t_move)
-            else:
-                print("play pass")
-                g.play(None)
-            g.display_goban()
-            total_turn += 1
-            if total_turn > turn_max:
-                break
+@cli.command()
+@click.option("-s", "--board-size", type=click.Choice(["9", "13", "19"]), default="13")
+@click.option("-c", "--checkpoint", default="./modelWeights.ckpt")
+@click.option("-o", "--output", type=click.Path(), default="./frozenModel.pb")
+def export(board_size, checkpoint, output):
+    # Frozen inference graph of a checkpoint (batch norm folded, training ops stripped)
+    from GoNeuralNetwork import GoNeuralNetwork
+    GoNeuralNetwork.export_inference_graph(int(board_size), output, checkpoint)
 
-        if total_turn > turn_max:
-            winner = 2  # draw
-            print("(Draw due to maximum moves)")
-        else:
-            score = g.outcome()
-            print(score)
-            winner = 2 if score[0] == score[1] else 0 if score[0] > score[1] else 1
-        go_agent.end_game(winner)
+
+@cli.command()
+@click.argument("frozen-graph", type=click.Path(exists=True), default="./frozenModel.pb")
+@click.option("-s", "--board-size", type=click.Choice(["9", "13", "19"]), default="13")
+@click.option("-n", "--games", default=1)
+@click.option("--cache-size", default=0, help="Positions kept in the evaluation cache (0 for no cache)")
+@click.option("--symmetric-cache", is_flag=True, default=False,
+              help="Symmetric positions share their cache entry (policies transformed back)")
+def play(frozen_graph, board_size, games, cache_size, symmetric_cache):
+    # Self-play games of an exported network, without the training graph
+    from GoNNAgent import GoNNAgent
+    board_size = int(board_size)
+    go_agent = GoNNAgent(board_size, frozen_graph, cache_size, symmetric_cache)
+    results = [0, 0, 0]
+    for i in range(games):
+        results[self_play_game(go_agent, board_size, i)] += 1
+    print("player 0: {} wins - player 1: {} wins - draws: {}".format(*results))
+    if go_agent.neural_network.cache is not None:
+        print("evaluation cache: {hits} hits, {misses} misses ({hit_rate:.1%})".format(
+            **go_agent.neural_network.cache.stats()))
 
 
 @learn.command()
@@ -74,13 +140,59 @@ def reinforcement(board_size):
 @click.option("-e", "--epoch", default=5000)
 @click.option("--report-freq", default=500)
 @click.option("--data-size", default=25000)
-def supervised(path_dataset, board_size, epoch, report_freq, data_size):
+@click.option("--prefetch-workers", default=2, help="Threads (or processes) preparing the batches, 0 to prepare them inline")
+@click.option("--prefetch-processes", is_flag=True, default=False, help="Prepare the batches in processes instead of threads")
+@click.option("--tf-data", is_flag=True, default=False, help="Train from TFRecord shards through an in-graph tf.data pipeline")
+@click.option("--dense-policy", is_flag=True, default=False, help="One-hot policy targets instead of move indices")
+@click.option("--cache-dir", type=click.Path(), default="prepared_cache", help="Cache of the sampled positions and training records ('' to disable)")
+@click.option("--profile", type=click.Path(), default="training_profile.jsonl", help="JSONL file of the step timing summaries")
+@click.option("--profile-freq", default=100, help="Steps per timing summary")
+@click.option("--trace-freq", default=0, help="Write a Chrome trace of the session.run every N steps (0 for never)")
+@click.option("--trace-prefix", default="timeline", help="Chrome traces are written to <prefix>-<step>.json")
+def supervised(path_dataset, board_size, epoch, report_freq, data_size, prefetch_workers, prefetch_processes, tf_data,
+               dense_policy, cache_dir, profile, profile_freq, trace_freq, trace_prefix):
     # Supervised training
     from GoNeuralNetwork import GoNeuralNetwork
     from supervised import supervised_training
-    neural_network = GoNeuralNetwork(board_size, training_mode="supervised")
+    neural_network = GoNeuralNetwork(board_size, training_mode="supervised", sparse_policy=not dense_policy)
     supervised_training(path_dataset, board_size, neural_network, epoch, report_freq, 
-                        data_size=data_size)
+                        data_size=data_size, prefetch_workers=prefetch_workers,
+                        prefetch_processes=prefetch_processes, tf_data=tf_data, sparse_policy=not dense_policy,
+                        cache_dir=cache_dir or None, profile_file=profile,
+                        profile_frequency=profile_freq, trace_frequency=trace_freq, trace_prefix=trace_prefix)
+
+
+@cli.group()
+def bench():
+    pass
+
+
+@bench.command("sgf-parser")
+@click.argument("path", type=click.Path(exists=True))
+@click.option("-n", "--num-files", default=0, help="Only parse the first N files (0 for all)")
+@click.option("-r", "--repeat", default=5)
+def sgf_parser(path, num_files, repeat):
+    from benchmarks import bench_sgf_parser
+    bench_sgf_parser(path, num_files, repeat)
+
+
+@bench.command("preprocessing")
+@click.argument("path", type=click.Path(exists=True), default="../Datasets/KGS_Chinese_Dataset_2018_11/")
+@click.option("-n", "--num-files", default=200, help="Run on the first N files (0 for all)")
+@click.option("-o", "--output", type=click.Path(), default="bench_preprocessing.json")
+@click.option("-s", "--stage", "stages", multiple=True, help="Only run these stages (all by default)")
+def preprocessing(path, num_files, output, stages):
+    from benchmarks import bench_preprocessing
+    bench_preprocessing(path, num_files, output, list(stages))
+
+
+@bench.command("augmentation")
+@click.option("-b", "--batch-size", default=32)
+@click.option("-s", "--board-size", default=19)
+@click.option("-r", "--repeat", default=20)
+def augmentation(batch_size, board_size, repeat):
+    from benchmarks import bench_augmentation
+    bench_augmentation(batch_size, board_size, repeat=repeat)
 
 
 if __name__ == "__main__":
@@ -8,11 +8,20 @@ Example usage::
             with zfile.mmap(data_name) as data:
                 # do anything to memory-mapped ``data``
                 ...
+
+    Entries stored without compression (``numpy.savez``) can also be
+    memory-mapped in place, without a temporary copy::
+
+    .. code-block::
+
+        with NpzMMap(my_npzfile) as zfile:
+            data = zfile.memmap(data_name)
 """
 
 import os
 import logging
 import shutil
+import struct
 import contextlib
 import tempfile
 import zipfile
@@ -110,6 +119,46 @@ class NpzMMap:
         assert key in self._zfile.namelist(), str(key)
         return _TempMMap(self._zfile.open(key), mmap_mode)
 
+    def memmap(self, key: str):
+        """
+        Memory-map an entry in place, the array stays valid after
+        ``close``. ``self.npzfile`` must be a file name.
+
+        :param key: which entry in ``self.npzfile`` to memory-map.
+        :return: read-only ``numpy.memmap`` (an empty array if the entry
+                 has no element, which cannot be mapped)
+        :raise KeyError: if ``key`` is not in ``keys()`` of ``self.npzfile``
+        :raise ValueError: if the entry is compressed, see ``mmap``
+        """
+        if key not in self.npzkeys:
+            raise KeyError('key "{}" not in npzfile "{}"'
+                           .format(key, self.npzfile))
+        if key not in self._zfile.namelist():
+            key += '.npy'
+        info = self._zfile.getinfo(key)
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError('entry "{}" of npzfile "{}" is compressed'
+                             .format(key, self.npzfile))
+        with open(self.npzfile, 'rb') as f:
+            # Local file header, then the npy header, then the data
+            f.seek(info.header_offset)
+            header = f.read(zipfile.sizeFileHeader)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + zipfile.sizeFileHeader
+                   + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.npzfile, dtype=dtype, mode='r', offset=offset,
+                         shape=shape, order='F' if fortran_order else 'C')
+
     def __enter__(self):
         return self
 
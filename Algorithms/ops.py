@@ -121,6 +121,41 @@ def conv(X,
                                            name="conv2d"), b)
 
 
+def network_input(board_planes, player_turn):
+    # [N, size, size, planes] uint8 board planes and [N] player turns to the float32 network input, the player
+    # feature plane is broadcast in the graph
+    board_planes = tf.cast(board_planes, tf.float32)
+    player_planes = tf.ones_like(board_planes[:, :, :, :1]) * tf.reshape(tf.cast(player_turn, tf.float32),
+                                                                         [-1, 1, 1, 1])
+    return tf.concat([board_planes, player_planes], axis=3)
+
+
+FOLDED_BATCH_NORM = "folded_batch_norm"
+
+
+def folded_conv(inputs, layer_name, batch_norm_variables, stride, epsilon=1e-3):
+    """
+    Conv of conv_layer layer_name followed by its batch norm (inference mode) as a single conv: W * scale and
+    (b - mean) * scale + beta, scale = gamma / sqrt(variance + epsilon). The folded weights are variables outside of
+    the global variables (not restored from checkpoints), the ops assigning them are in the FOLDED_BATCH_NORM
+    collection.
+    """
+    batch_norm = {v.op.name.split("/")[-1]: v for v in batch_norm_variables}
+    with tf.variable_scope(layer_name, reuse=True):
+        W, b = tf.get_variable("W_conv"), tf.get_variable("b_conv")
+    scale = batch_norm["gamma"] * tf.rsqrt(batch_norm["moving_variance"] + epsilon)
+    with tf.variable_scope(layer_name + "_folded"):
+        W_folded = tf.get_variable("W_conv", shape=W.shape, dtype=W.dtype, trainable=False,
+                                   collections=[FOLDED_BATCH_NORM + "_variables"])
+        b_folded = tf.get_variable("b_conv", shape=b.shape, dtype=b.dtype, trainable=False,
+                                   collections=[FOLDED_BATCH_NORM + "_variables"])
+    tf.add_to_collection(FOLDED_BATCH_NORM, W_folded.assign(W * scale))
+    tf.add_to_collection(FOLDED_BATCH_NORM, b_folded.assign((b - batch_norm["moving_mean"]) * scale +
+                                                            batch_norm["beta"]))
+    return tf.nn.bias_add(tf.nn.conv2d(inputs, W_folded, strides=[1, stride, stride, 1], padding='SAME',
+                                       name="conv2d"), b_folded)
+
+
 def conv_out_size(W, F, P, S):
     # W : input size (width or height)
     # F : filters size
@@ -130,7 +165,9 @@ def conv_out_size(W, F, P, S):
 
 
 def conv_layer(inputs, filters, kernel, stride, activation, layer_name, use_batch_norm, drop_out,
-               is_train, weight_initializer=xavier_initializer()):
+               is_train, weight_initializer=xavier_initializer(), fold_batch_norm=False):
+    # fold_batch_norm: inference only, the output is a single conv whose weights are set by the ops of the
+    # FOLDED_BATCH_NORM collection to the conv weights with the batch norm folded in
     layer = conv(inputs,
                  filters,
                  kernel=[kernel, kernel],
@@ -138,18 +175,24 @@ def conv_layer(inputs, filters, kernel, stride, activation, layer_name, use_batc
                  w_initializer=weight_initializer,
                  name=layer_name)
     if use_batch_norm:
-        layer = tf.layers.batch_normalization(layer, training=is_train)
+        # The batch norm variables keep the names of the training graph
+        variables = set(tf.global_variables())
+        batch_norm = tf.layers.batch_normalization(layer, training=is_train)
+        if fold_batch_norm:
+            layer = folded_conv(inputs, layer_name, [v for v in tf.global_variables() if v not in variables], stride)
+        else:
+            layer = batch_norm
     layer = activation(layer)
     layer = tf.layers.dropout(layer, rate=drop_out, training=is_train)
     return layer
 
 
 def residual_conv_block(inputs, filters, kernel, stride, activation, layer_name, use_batch_norm,
-                        drop_out, is_train, weight_initializer=xavier_initializer()):
+                        drop_out, is_train, weight_initializer=xavier_initializer(), fold_batch_norm=False):
     layer = conv_layer(inputs, filters, kernel, stride, activation, layer_name + "_1", use_batch_norm, drop_out,
-                       is_train, weight_initializer)
+                       is_train, weight_initializer, fold_batch_norm)
     layer = conv_layer(layer, filters, kernel, stride, tf.identity, layer_name + "_2", use_batch_norm, drop_out,
-                       is_train, weight_initializer)
+                       is_train, weight_initializer, fold_batch_norm)
     layer += inputs
     layer = activation(layer)
     return layer
@@ -200,40 +243,71 @@ def data_transformation(planes, policy, board_size, k_rotate, reflection):
     return new_planes, new_p
 
 
-# Data augmentation from raw neural network inputs
-def data_augmentation_single(planes, policy, board_size, idx=None):
-    out_planes = []
-    out_policies = []
-
-    all_reflection = [False, True]
-    all_rotate = list(range(0, 4))
-    all_transformation = list(itertools.product(all_reflection, all_rotate))
-    if idx is None:
-        reflection_to_do, rotate_to_do = all_reflection, all_rotate
-    else:
-        reflection_to_do, rotate_to_do = [all_transformation[idx][0]], [all_transformation[idx][1]]
-
-    for reflection in reflection_to_do:
-        for k_rotate in rotate_to_do:
-            new_planes, new_p = data_transformation(planes, policy, board_size, k_rotate, reflection)
+def dihedral_batch(states, policies, board_size, symmetries):
+    """
+    Applies a dihedral transformation to every sample of a batch at once.
+    :param states: [N, size, size, planes]
+    :param policies: [N, size * size + 1], [N] move indices or None (states only)
+    :param symmetries: the idx (see data_augmentation_single) of the transformation of each sample, or one idx for all
+    :return: the transformed states and policies
+    """
+    n = len(states)
+    symmetries = np.broadcast_to(symmetries, (n,))
+    rows = np.arange(n)[:, None]
+    flat_states = np.reshape(states, (n, board_size * board_size, -1))
+    new_states = np.reshape(flat_states[rows, dihedral_permutations(board_size)[symmetries]], np.shape(states))
+    if policies is None:
+        return new_states, None
+    if np.ndim(policies) == 1:
+        return new_states, dihedral_move_permutations(board_size)[symmetries, policies]
+    new_policies = np.asarray(policies)[rows, dihedral_policy_permutations(board_size)[symmetries]]
+    return new_states, new_policies
+
+
+def dihedral_inverse_policies(policies, board_size, symmetries):
+    # Policies of transformed positions (see dihedral_batch) back to the orientation of the original positions
+    policies = np.asarray(policies)
+    symmetries = np.broadcast_to(symmetries, (len(policies),))
+    return policies[np.arange(len(policies))[:, None], dihedral_move_permutations(board_size)[symmetries]]
 
-            out_planes.append(new_planes)
-            out_policies.append(new_p)
 
-    return out_planes, out_policies
+# Data augmentation from raw neural network inputs
+def data_augmentation_single(planes, policy, board_size, idx=None):
+    # planes [1, size, size, no_input_planes], policy [1, size * size + 1]
+    symmetries = np.arange(8) if idx is None else np.array([idx])
+    new_planes, new_policies = dihedral_batch(np.repeat(planes, len(symmetries), axis=0),
+                                              np.repeat(np.reshape(policy, (1, -1)), len(symmetries), axis=0),
+                                              board_size, symmetries)
+    return list(new_planes[:, None]), list(new_policies[:, None])
 
 
 def data_augmentation(states, policies, values, board_size, input_planes, idx=None):
     # states   [N, size, size, no_input_planes]
     # policies [N, size * size + 1]
     # values   [N, 1]
-    # idx: value between 0 and 7 or None (choose a particular augmentation or all)
+    # idx: value between 0 and 7, one per sample or None (choose a particular augmentation or all)
+    states, policies, values = reshape_data_for_network(states, policies, values, board_size, input_planes)
+    if idx is None:
+        # The 8 transformations of each sample, one after the other
+        idx = np.tile(np.arange(8), len(states))
+        states, policies, values = (np.repeat(states, 8, axis=0), np.repeat(policies, 8, axis=0),
+                                    np.repeat(values, 8, axis=0))
+    states, policies = dihedral_batch(states, policies, board_size, idx)
+    return states, policies, values
+
 
+def data_augmentation_legacy(states, policies, values, board_size, input_planes, idx=None):
+    # Sample by sample, plane by plane, kept as the baseline of the augmentation benchmark
     t_states, t_policies, t_values = reshape_data_for_augmentation(states, policies, values, board_size, input_planes)
     new_states, new_policies, new_values = [], [], []
     for i in range(len(t_states)):
         state, policy, value = t_states[i], t_policies[i], t_values[i]
-        aug_states, aug_policies = data_augmentation_single(state, policy, board_size, idx=idx)
+        aug_states, aug_policies = [], []
+        all_transformation = list(itertools.product([False, True], range(0, 4)))
+        for reflection, k_rotate in (all_transformation if idx is None else [all_transformation[idx]]):
+            new_planes, new_p = data_transformation(state, policy, board_size, k_rotate, reflection)
+            aug_states.append(new_planes)
+            aug_policies.append(new_p)
         for j in range(len(aug_states)):
             new_states.append(aug_states[j])
             new_policies.append(aug_policies[j])
@@ -242,6 +316,81 @@ def data_augmentation(states, policies, values, board_size, input_planes, idx=No
     return reshape_data_for_network(new_states, new_policies, new_values, board_size, input_planes)
 
 
+def dihedral_permutations(board_size):
+    """
+    Index tables of the 8 dihedral transformations of a board, in the order of the "idx" of data_augmentation_single.
+    :return: [8, size * size] int array, the flattened transformation of a plane is plane.flat[permutations[idx]]
+    """
+    if board_size not in _dihedral_permutations:
+        board = np.reshape(np.arange(board_size * board_size), (board_size, board_size))
+        all_transformation = itertools.product([False, True], range(0, 4))
+        _dihedral_permutations[board_size] = np.array([dihedral_transformation(board, k_rotate, reflection).ravel()
+                                                       for reflection, k_rotate in all_transformation])
+    return _dihedral_permutations[board_size]
+
+
+def dihedral_policy_permutations(board_size):
+    # dihedral_permutations extended with the pass move, which stays in place
+    permutations = dihedral_permutations(board_size)
+    pass_move = np.full((len(permutations), 1), board_size * board_size)
+    return np.concatenate([permutations, pass_move], axis=1)
+
+
+def dihedral_move_permutations(board_size):
+    # Inverse of dihedral_policy_permutations: move m of a policy index becomes move [idx, m] of the transformed one
+    return np.argsort(dihedral_policy_permutations(board_size), axis=1)
+
+
+_dihedral_permutations = {}
+
+
+#################################################
+# Hashing
+#################################################
+
+def zobrist_table(board_size, planes):
+    # One random 64 bits key per (point, plane) and one for the side to move, the same in every process
+    key = (board_size, planes)
+    if key not in _zobrist_tables:
+        rng = np.random.RandomState(board_size * 1000 + planes)
+        _zobrist_tables[key] = rng.randint(0, 2 ** 64, size=board_size * board_size * planes + 1, dtype=np.uint64)
+    return _zobrist_tables[key]
+
+
+def zobrist_hash(planes, board_size, player_turn=None, symmetric=False, block_size=1024, return_all=False):
+    """
+    Zobrist hash of board planes.
+    :param planes: [N, ..., size, size, C] board planes (non zero is a stone)
+    :param player_turn: [N] side to move, part of the hash if given
+    :param symmetric: hash the 8 dihedral transformations of each position and keep the smallest
+    :param return_all: also return the hashes [N, 8] of every transformation (only used if symmetric)
+    :return: hashes [N] uint64 and the idx of the transformation each hash comes from (always 0 if not symmetric)
+    """
+    planes = np.reshape(planes, (len(planes), board_size * board_size, -1)) != 0
+    num_planes = planes.shape[-1]
+    table = zobrist_table(board_size, num_planes)
+    turn_key, table = table[-1], np.reshape(table[:-1], (board_size * board_size, num_planes))
+    # Hashing the transformation of a position is hashing the position with the inversely permuted table
+    permutations = np.argsort(dihedral_permutations(board_size), axis=1) if symmetric else [np.arange(len(table))]
+    tables = [table[permutation] for permutation in permutations]
+
+    hashes = np.empty((len(planes), len(tables)), dtype=np.uint64)
+    for b in range(0, len(planes), block_size):
+        block = planes[b:b + block_size]
+        for i, t in enumerate(tables):
+            hashes[b:b + block_size, i] = np.bitwise_xor.reduce(np.where(block, t, np.uint64(0)), axis=(1, 2))
+    if player_turn is not None:
+        hashes ^= np.where(np.reshape(player_turn, (-1, 1)) == 1, turn_key, np.uint64(0))
+
+    idx = np.argmin(hashes, axis=1)
+    if return_all:
+        return hashes[np.arange(len(hashes)), idx], idx, hashes
+    return hashes[np.arange(len(hashes)), idx], idx
+
+
+_zobrist_tables = {}
+
+
 #################################################
 # Reshaping
 #################################################
@@ -265,7 +414,7 @@ def goban_1D_to_goban_2D(goban, size):
 
 
 def goban_to_nn_state(goban, board_size, dtype = bool):
-    return np.reshape(goban, (1, -1, board_size, 1), dtype=dtype)
+    return np.reshape(np.asarray(goban, dtype=dtype), (1, -1, board_size, 1))
 
 
 def goban_to_input_planes(goban, g_old, player_turn, size, dtype=bool):
@@ -307,6 +456,13 @@ def add_player_feature_plane(goban, board_size, player_turn):
     return planes
 
 
+def add_player_feature_planes(gobans, board_size, player_turn):
+    # Batched add_player_feature_plane: gobans [N, 1, size, size, planes], player_turn [N]
+    player_feature_planes = np.broadcast_to(np.reshape(np.asarray(player_turn, dtype=gobans.dtype), (-1, 1, 1, 1, 1)),
+                                            (len(gobans), 1, board_size, board_size, 1))
+    return np.concatenate([gobans, player_feature_planes], axis=4)
+
+
 #################################################
 # Other
 #################################################
@@ -0,0 +1,651 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+from numpy.lib import format as npformat
+
+import ops
+from libgoban import IGame
+from mmapnpz import NpzMMap
+
+DATASET_KEYS = ["states", "policies", "values", "player_turn"]
+COMPACT_KEYS = ["states", "moves", "values", "player_turn"]
+
+
+# ------------------------------------------
+# ------------- Compact format -------------
+# ------------------------------------------
+
+# states      [N, ceil(size * size * 4 / 8)] uint8, the 4 board planes bit-packed
+# moves       [N] uint16, index of the played move (size * size for pass)
+# values      [N] int8
+# player_turn [N] int8
+
+def pack_states(states):
+    states = np.asarray(states, dtype=bool)
+    return np.packbits(np.reshape(states, (len(states), -1)), axis=1)
+
+
+def unpack_states(packed, board_size, planes=4):
+    states = np.unpackbits(packed, axis=1, count=board_size * board_size * planes)
+    return np.reshape(states.view(bool), (-1, 1, board_size, board_size, planes))
+
+
+def moves_to_policies(moves, board_size):
+    policies = np.zeros((len(moves), board_size * board_size + 1))
+    policies[np.arange(len(moves)), moves] = 1
+    return policies
+
+
+def is_compact(npzfile):
+    return "moves" in npzfile
+
+
+# ------------------------------------------
+# ------------ Move-list format ------------
+# ------------------------------------------
+
+# Every game once, positions are replayed when they are drawn
+# sizes         [G] uint8, board size
+# komi          [G] float32
+# winners       [G] int8, 0 black, 1 white, 2 unknown
+# setup         [sum of setup lengths] uint16, moves played before the game (handicap stones and passes)
+# setup_offsets [G + 1] int64, game g setup is setup[setup_offsets[g]:setup_offsets[g + 1]]
+# moves         [sum of game lengths] uint16, move index (size * size for pass), MOVE_PLAYER_BIT set for white
+# move_offsets  [G + 1] int64, game g moves are moves[move_offsets[g]:move_offsets[g + 1]]
+
+MOVE_PLAYER_BIT = 1 << 15
+
+
+def is_games(npzfile):
+    return "move_offsets" in npzfile
+
+
+def save_games(games, out_file):
+    """Writes a list of (size, komi, winner, setup, moves) games in the move-list format."""
+    def offsets(lists):
+        return np.cumsum([0] + [len(elems) for elems in lists], dtype=np.int64)
+
+    setups, moves = [game[3] for game in games], [game[4] for game in games]
+    np.savez(out_file,
+             sizes=np.array([game[0] for game in games], dtype=np.uint8),
+             komi=np.array([game[1] for game in games], dtype=np.float32),
+             winners=np.array([game[2] for game in games], dtype=np.int8),
+             setup=np.array([move for setup in setups for move in setup], dtype=np.uint16),
+             setup_offsets=offsets(setups),
+             moves=np.array([move for game in moves for move in game], dtype=np.uint16),
+             move_offsets=offsets(moves))
+
+
+def replay_positions(board_size, setup, moves, steps=None):
+    """
+    Replays a game and returns its input planes before the moves of index steps.
+    :param setup: moves played before the game
+    :param moves: the moves of the game, with the player bit
+    :param steps: sorted move indices, all the game if None
+    :return: (len(steps), 1, board_size, board_size, 4) bool
+    """
+    pass_move = board_size * board_size
+    if steps is None:
+        steps = range(len(moves))
+    states = np.empty((len(steps), 1, board_size, board_size, 4), dtype=bool)
+    if len(steps) == 0:
+        return states
+
+    g = IGame(board_size)
+    for move in setup:
+        g.play(None if move == pass_move else (move // board_size, move % board_size))
+
+    # The planes of a position only depend on it and on the previous one
+    g_old = np.full((1, board_size, board_size, 2), 0)
+    i = 0
+    for t in range(steps[-1] + 1):
+        move = moves[t] & (MOVE_PLAYER_BIT - 1)
+        if steps[i] == t or steps[i] == t + 1:
+            goban, g_old = ops.goban_to_input_planes(g.raw_goban_split(), g_old, moves[t] >> 15, board_size)
+            if steps[i] == t:
+                states[i] = goban
+                i += 1
+        g.play(None if move == pass_move else (move // board_size, move % board_size))
+    return states
+
+
+class GameDataset:
+    """Positions of a move-list dataset, replayed on demand.
+
+    Moves, values and player turns of every position are held in memory
+    (a few bytes each), the board planes are rebuilt by ``states`` for the
+    positions drawn, replaying each game up to its last drawn position.
+    """
+
+    def __init__(self, dataset):
+        with np.load(dataset) as npzfile:
+            self.sizes = npzfile["sizes"]
+            self.winners = npzfile["winners"]
+            self.setup = npzfile["setup"]
+            self.setup_offsets = npzfile["setup_offsets"]
+            self.game_moves = npzfile["moves"]
+            self.move_offsets = npzfile["move_offsets"]
+        if len(np.unique(self.sizes)) > 1:
+            raise ValueError("{} mixes board sizes {}".format(dataset, np.unique(self.sizes)))
+        self.board_size = int(self.sizes[0]) if len(self.sizes) else 19
+
+        # Per position, in game order
+        self.games = np.repeat(np.arange(len(self.sizes)), np.diff(self.move_offsets))
+        self.player_turn = (self.game_moves >> 15).astype(np.int8)
+        self.moves = self.game_moves & np.uint16(MOVE_PLAYER_BIT - 1)
+        winners = self.winners[self.games]
+        self.values = np.where(winners == 2, 0, np.where(winners == self.player_turn, 1, -1)).astype(np.int8)
+
+    def __len__(self):
+        return len(self.moves)
+
+    def states(self, positions):
+        positions = np.asarray(positions)
+        states = np.empty((len(positions), 1, self.board_size, self.board_size, 4), dtype=bool)
+        if len(positions) == 0:
+            return states
+        order = np.argsort(positions, kind="stable")
+        games = self.games[positions[order]]
+        # One replay per game, up to its last drawn position
+        bounds = np.flatnonzero(np.diff(games)) + 1
+        for rows in np.split(order, bounds):
+            game = self.games[positions[rows[0]]]
+            begin, end = self.move_offsets[game], self.move_offsets[game + 1]
+            steps, inverse = np.unique(positions[rows] - begin, return_inverse=True)
+            setup = self.setup[self.setup_offsets[game]:self.setup_offsets[game + 1]]
+            replayed = replay_positions(self.board_size, setup, self.game_moves[begin:end], steps)
+            states[rows] = replayed[inverse]
+        return states
+
+    def gather(self, positions):
+        # Same rows as a compact dataset, with unpacked states
+        return self.states(positions), self.moves[positions], self.values[positions], self.player_turn[positions]
+
+
+# ------------------------------------------
+# ---------------- Loading -----------------
+# ------------------------------------------
+
+class MMapDataset:
+    """Rows of a dense or compact dataset, memory-mapped from its shards.
+
+    ``dataset`` is an npz file or a prepros output folder, whose chunks
+    (listed in its manifest) are mapped in order instead of the
+    consolidated file. ``gather`` only reads the rows it is asked for, so
+    the dataset does not have to fit in memory.
+    """
+
+    def __init__(self, dataset):
+        if os.path.isdir(dataset):
+            manifest = load_manifest(os.path.join(dataset, "manifest.json"))
+            files = [os.path.join(dataset, chunk_file) for shard_name in sorted(manifest["shards"])
+                     for chunk_file in manifest["shards"][shard_name]["chunks"]]
+        else:
+            files = [dataset]
+        self.shards = []
+        for file_name in files:
+            with NpzMMap(file_name) as zfile:
+                self.compact = "moves" in zfile.npzkeys
+                self.shards.append([zfile.memmap(key) for key in (COMPACT_KEYS if self.compact else DATASET_KEYS)])
+        self.offsets = np.cumsum([0] + [len(shard[2]) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def gather(self, positions):
+        # Rows as stored, read in increasing order from each shard and returned in the order asked
+        positions = np.asarray(positions, dtype=np.int64)
+        order = np.argsort(positions, kind="stable")
+        sorted_positions = positions[order]
+        shard_ids = np.searchsorted(self.offsets, sorted_positions, side="right") - 1
+        parts = [[array[:0]] for array in self.shards[0]]
+        for shard_id in np.unique(shard_ids):
+            rows = sorted_positions[shard_ids == shard_id] - self.offsets[shard_id]
+            for part, array in zip(parts, self.shards[shard_id]):
+                part.append(array[rows])
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return tuple(np.concatenate(part)[inverse] for part in parts)
+
+
+def expand_batch(states, policies, values, player_turn, board_size, sparse_policy=False):
+    """
+    Stored rows to the compact neural network inputs, one batch at a time.
+    :param sparse_policy: policies as move indices instead of one-hot (see GoNeuralNetwork sparse_policy)
+    :return: board planes [N, size, size, 4] uint8, policies [N, size * size + 1] (or [N] moves), values [N, 1],
+    player_turn [N] (see GoNeuralNetwork.input_feed)
+    """
+    if states.dtype == np.uint8 and states.ndim == 2:
+        states = unpack_states(states, board_size)
+    if sparse_policy and policies.ndim == 2:
+        policies = np.argmax(policies, axis=1)
+    elif not sparse_policy and policies.ndim == 1:
+        policies = moves_to_policies(policies, board_size)
+    board_planes = np.reshape(states, (len(states), board_size, board_size, -1)).view(np.uint8)
+    return board_planes, policies, np.reshape(values, (-1, 1)), np.asarray(player_turn)
+
+
+class EpochSampler:
+    """Train, validation and test splits of a dataset as row indices.
+
+    Only a permutation of the row indices is held, the dataset is never
+    copied. Fold ``k`` of the ``int(1 / test_ratio)`` folds is the test
+    set, the ``validation_ratio`` rows after it the validation set (the
+    test set itself when 0) and the rest, taken circularly, the training
+    set.
+    """
+
+    def __init__(self, num_positions, test_ratio=1 / 30, validation_ratio=0., k=0, data_size=0, seed=0):
+        self.rng = np.random.RandomState(seed)
+        self.permutation = self.rng.permutation(num_positions)
+        if 0 < data_size < num_positions:
+            self.permutation = self.permutation[:data_size]
+        self.test_ratio = test_ratio
+        self.validation_ratio = validation_ratio
+        self.num_folds = max(int(1 / test_ratio), 1) if test_ratio > 0 else 1
+        self.set_fold(k)
+
+    def set_fold(self, k):
+        n = len(self.permutation)
+        self.k = min(k, self.num_folds - 1)
+        self.test_size = int(n * self.test_ratio)
+        self.validation_size = int(n * self.validation_ratio)
+        self._test_begin = int(n * self.test_ratio * self.k)
+        self._train_begin = self._test_begin + self.test_size + self.validation_size
+        self.train_size = max(n - self.test_size - self.validation_size, 0)
+
+    def _circular(self, begin, size):
+        if begin + size <= len(self.permutation):
+            return self.permutation[begin:begin + size]
+        return np.take(self.permutation, np.arange(begin, begin + size), mode="wrap")
+
+    def test_positions(self):
+        return self._circular(self._test_begin, self.test_size)
+
+    def validation_positions(self):
+        if self.validation_size == 0:
+            return self.test_positions()
+        return self._circular(self._test_begin + self.test_size, self.validation_size)
+
+    def reindex(self):
+        """
+        Makes the positions rows of a dataset holding the sampled positions in the order of the permutation (see
+        cache_positions), the splits stay the same.
+        """
+        self.permutation = np.arange(len(self.permutation))
+
+    def train_positions(self, rows):
+        # Rows of the training set to dataset positions
+        return self.permutation[(self._train_begin + np.asarray(rows)) % len(self.permutation)]
+
+    def __len__(self):
+        return self.train_size
+
+    def num_batches(self, batch_size):
+        return self.train_size // batch_size
+
+    def epoch(self, batch_size, replacement=False):
+        """
+        Yields the batches of positions of one training epoch: a new permutation of the training set cut in
+        len // batch_size batches, or as many batches drawn with replacement.
+        """
+        if replacement:
+            for _ in range(self.num_batches(batch_size)):
+                yield self.train_positions(self.rng.randint(low=0, high=self.train_size, size=batch_size))
+            return
+        rows = self.rng.permutation(self.train_size)
+        for b in range(self.num_batches(batch_size)):
+            yield self.train_positions(rows[b * batch_size:(b + 1) * batch_size])
+
+
+# ------------------------------------------
+# ---------------- Writing -----------------
+# ------------------------------------------
+
+class DatasetWriter:
+    """Streams positions to disk in chunks of ``chunk_size`` rows.
+
+    Rows are copied into preallocated buffers which are flushed to
+    ``<prefix>_chunk_<n>.npz`` once full, so memory does not grow with the
+    number of games. Chunks written before a crash stay on disk. With
+    ``compact`` the rows are stored in the compact format.
+    """
+
+    def __init__(self, prefix, chunk_size=50000, compact=False):
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.compact = compact
+        self.keys = COMPACT_KEYS if compact else DATASET_KEYS
+        self.chunk_files = []
+        self.num_positions = 0
+        self._buffers = None
+        self._fill = 0
+
+    def _rows(self, states, policies, values, player_turn):
+        if self.compact:
+            # Rows of a compact dataset (packed states, moves) are taken as they are
+            states, policies = np.asarray(states), np.asarray(policies)
+            return [states if states.dtype == np.uint8 and states.ndim == 2 else pack_states(states),
+                    (policies if policies.ndim == 1 else np.argmax(policies, axis=1)).astype(np.uint16),
+                    np.asarray(values, dtype=np.int8),
+                    np.asarray(player_turn, dtype=np.int8)]
+        return [np.asarray(states), np.asarray(policies), np.asarray(values), np.asarray(player_turn)]
+
+    def add(self, state, policy, value, player_turn):
+        self.add_game([state], [policy], [value], [player_turn])
+
+    def add_game(self, states, policies, values, player_turn):
+        if len(values) == 0:
+            return
+        rows = self._rows(states, policies, values, player_turn)
+        if self._buffers is None:
+            self._buffers = {key: np.empty((self.chunk_size,) + row.shape[1:], dtype=row.dtype)
+                             for key, row in zip(self.keys, rows)}
+        done = 0
+        while done < len(values):
+            count = min(len(values) - done, self.chunk_size - self._fill)
+            for key, row in zip(self.keys, rows):
+                self._buffers[key][self._fill:self._fill + count] = row[done:done + count]
+            self._fill += count
+            self.num_positions += count
+            done += count
+            if self._fill == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self._fill == 0:
+            return
+        chunk_file = "{}_chunk_{:05d}.npz".format(self.prefix, len(self.chunk_files))
+        # Written under a temporary name so a chunk on disk is always complete
+        with open(chunk_file + ".tmp", "wb") as f:
+            np.savez(f, **{key: buffer[:self._fill] for key, buffer in self._buffers.items()})
+        os.replace(chunk_file + ".tmp", chunk_file)
+        self.chunk_files.append(chunk_file)
+        self._fill = 0
+
+    def close(self):
+        self.flush()
+        return self.chunk_files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        self.close()
+
+
+# ------------------------------------------
+# ------------- Consolidation --------------
+# ------------------------------------------
+
+def _npz_array_header(zfile, key):
+    with zfile.open(key + ".npy") as f:
+        version = npformat.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npformat.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = npformat.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def _chunks_headers(chunk_files):
+    # Keys, total shapes and dtypes of the chunks from the npy headers only
+    with zipfile.ZipFile(chunk_files[0]) as zfile:
+        keys = [name[:-len(".npy")] for name in zfile.namelist()]
+    shapes, dtypes = {}, {}
+    for chunk_file in chunk_files:
+        with zipfile.ZipFile(chunk_file) as zfile:
+            for key in keys:
+                shape, dtype = _npz_array_header(zfile, key)
+                if key in shapes:
+                    shapes[key] = (shapes[key][0] + shape[0],) + shapes[key][1:]
+                else:
+                    shapes[key], dtypes[key] = shape, dtype
+    return keys, shapes, dtypes
+
+
+def _chunks_blocks(chunk_files, key, masks=None):
+    # The rows of key one chunk at a time, only the masked ones if masks are given
+    for i, chunk_file in enumerate(chunk_files):
+        with np.load(chunk_file) as chunk:
+            block = chunk[key]
+        yield block if masks is None else block[masks[i]]
+
+
+def _write_npz(out_file, entries):
+    # Same file as np.savez, entries are (key, dtype, shape, blocks) and each array is written block by block
+    with zipfile.ZipFile(out_file, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as zout:
+        for key, dtype, shape, blocks in entries:
+            with zout.open(key + ".npy", "w", force_zip64=True) as f:
+                npformat.write_array_header_1_0(f, {"descr": npformat.dtype_to_descr(dtype),
+                                                    "fortran_order": False,
+                                                    "shape": shape})
+                for block in blocks:
+                    f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+
+
+def consolidate_chunks(chunk_files, out_file, remove_chunks=True, dedup=None, symmetric=True):
+    """Concatenates the chunks, in order, into a single npz dataset.
+
+    Arrays are written one chunk at a time so only one chunk is held in
+    memory. The output is the same file ``np.savez`` would have written
+    from the concatenated arrays.
+
+    ``dedup`` removes repeated positions, see ``dedup_chunks``. It returns
+    the deduplication report.
+    """
+    report = None
+    if not chunk_files:
+        np.savez(out_file, **{key: [] for key in DATASET_KEYS})
+    elif dedup is not None:
+        report = dedup_chunks(chunk_files, out_file, dedup, symmetric)
+    else:
+        keys, shapes, dtypes = _chunks_headers(chunk_files)
+        _write_npz(out_file, [(key, dtypes[key], shapes[key], _chunks_blocks(chunk_files, key)) for key in keys])
+
+    if remove_chunks:
+        for chunk_file in chunk_files:
+            os.remove(chunk_file)
+    return report
+
+
+# ------------------------------------------
+# ------------ Deduplication ---------------
+# ------------------------------------------
+
+def _chunk_positions(chunk, symmetric):
+    # Zobrist hash of every position, the move seen from the transformation the hash comes from, the canonical move
+    # and the board size
+    states = chunk["states"]
+    if is_compact(chunk):
+        board_size = int(np.sqrt(states.shape[1] * 2))
+        moves = chunk["moves"]
+        states = unpack_states(states, board_size)
+    else:
+        board_size = states.shape[-2]
+        moves = np.argmax(chunk["policies"], axis=1)
+    hashes, idx, all_hashes = ops.zobrist_hash(states, board_size, chunk["player_turn"], symmetric=symmetric,
+                                               return_all=True)
+    inverse = ops.dihedral_move_permutations(board_size)
+    # The transformations of a self-symmetric position (empty board, mirrored openings...) all reach the smallest
+    # hash, its equivalent moves (the four 4-4 points...) are the same canonical move: the smallest over them
+    tied = all_hashes == hashes[:, None]
+    candidates = inverse[:len(tied[0])][:, moves].T
+    canonical = np.where(tied, candidates, np.iinfo(candidates.dtype).max).min(axis=1)
+    return hashes, inverse[idx, moves], canonical, idx, board_size
+
+
+def dedup_chunks(chunk_files, out_file, mode="drop", symmetric=True):
+    """Consolidates the chunks without the repeated positions.
+
+    Positions are identified by the Zobrist hash of their board planes and
+    side to move, the smallest over the 8 dihedral transformations when
+    ``symmetric``.
+
+    - "drop" keeps the first occurrence of every (position, move) pair.
+    - "merge" keeps one row per position: its first occurrence, with the
+      played moves aggregated into the policy, the mean value and a
+      ``counts`` column. Only for datasets with one-hot policies.
+
+    The hashes of the whole dataset are held in memory, not the rows.
+    :return: the report of what was removed
+    """
+    keys, shapes, dtypes = _chunks_headers(chunk_files)
+    if mode == "merge" and "policies" not in keys:
+        raise ValueError("merge deduplication needs one-hot policies, not a compact dataset")
+    if mode not in ("drop", "merge"):
+        raise ValueError("unknown deduplication mode \"{}\"".format(mode))
+
+    hashes, moves, canonical, idx, values, sizes = [], [], [], [], [], []
+    for chunk_file in chunk_files:
+        with np.load(chunk_file) as chunk:
+            chunk_hashes, chunk_moves, chunk_canonical, chunk_idx, board_size = _chunk_positions(chunk, symmetric)
+            values.append(chunk["values"])
+        hashes.append(chunk_hashes)
+        moves.append(chunk_moves)
+        canonical.append(chunk_canonical)
+        idx.append(chunk_idx.astype(np.uint8))
+        sizes.append(len(chunk_hashes))
+    hashes, moves, idx, values = np.concatenate(hashes), np.concatenate(moves), np.concatenate(idx), np.concatenate(values)
+    canonical = np.concatenate(canonical)
+    bounds = np.cumsum([0] + sizes)
+
+    if mode == "drop":
+        # Mix the canonical move into the position hash
+        keys_hashes = hashes ^ (canonical.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+        _, first = np.unique(keys_hashes, return_index=True)
+    else:
+        _, first, group = np.unique(hashes, return_index=True, return_inverse=True)
+    keep = np.zeros(len(hashes), dtype=bool)
+    keep[first] = True
+    masks = [keep[bounds[i]:bounds[i + 1]] for i in range(len(chunk_files))]
+    num_kept = len(first)
+
+    def kept_shape(key):
+        return (num_kept,) + shapes[key][1:]
+
+    if mode == "drop":
+        entries = [(key, dtypes[key], kept_shape(key), _chunks_blocks(chunk_files, key, masks)) for key in keys]
+    else:
+        # Groups numbered in the order of their first occurrence, which is the order of the kept rows
+        group = np.reshape(group, -1)
+        rank = np.empty(num_kept, dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(num_kept)
+        group = rank[group]
+        counts = np.bincount(group, minlength=num_kept)
+        mean_values = np.bincount(group, weights=values, minlength=num_kept) / counts
+
+        # Every move seen from the orientation of the kept row, counted per group
+        policy_size = shapes["policies"][1]
+        forward = ops.dihedral_policy_permutations(board_size)
+        first_idx = idx[np.sort(first)]
+        pairs, pair_counts = np.unique(group * policy_size + forward[first_idx[group], moves], return_counts=True)
+
+        def policy_blocks(block_size=10000):
+            for b in range(0, num_kept, block_size):
+                lo, hi = np.searchsorted(pairs, [b * policy_size, (b + block_size) * policy_size])
+                block = np.zeros((min(block_size, num_kept - b), policy_size))
+                rows, cols = pairs[lo:hi] // policy_size, pairs[lo:hi] % policy_size
+                block[rows - b, cols] = pair_counts[lo:hi] / counts[rows]
+                yield block
+
+        entries = [("states", dtypes["states"], kept_shape("states"), _chunks_blocks(chunk_files, "states", masks)),
+                   ("policies", np.dtype(np.float64), kept_shape("policies"), policy_blocks()),
+                   ("values", np.dtype(np.float64), (num_kept,), [mean_values]),
+                   ("player_turn", dtypes["player_turn"], kept_shape("player_turn"),
+                    _chunks_blocks(chunk_files, "player_turn", masks)),
+                   ("counts", np.dtype(np.int64), (num_kept,), [counts])]
+    _write_npz(out_file, entries)
+
+    report = {"mode": mode,
+              "symmetric": symmetric,
+              "positions": int(len(hashes)),
+              "kept": int(num_kept),
+              "removed": int(len(hashes) - num_kept),
+              "removed_ratio": float(1. - num_kept / max(len(hashes), 1))}
+    print("Deduplication ({}): {} / {} positions removed ({:.1%})".format(mode, report["removed"],
+                                                                          report["positions"],
+                                                                          report["removed_ratio"]))
+    return report
+
+
+def load_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_file):
+    # Replaced in one step so an interrupted run never leaves a truncated manifest
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+# ------------------------------------------
+# ------------- Prepared cache -------------
+# ------------------------------------------
+
+# cache_dir/
+#   hashes.json          content hash of the datasets already hashed, by path, size and mtime
+#   positions_<key>.npz  compact dataset of the sampled positions, in the order of the sampler permutation
+#   records_<key>-*      TFRecord shards of a training set (see supervised_training)
+
+def dataset_files(dataset):
+    # Files holding the rows of an npz dataset or a prepros output folder
+    if not os.path.isdir(dataset):
+        return [dataset]
+    manifest = load_manifest(os.path.join(dataset, "manifest.json"))
+    return [os.path.join(dataset, chunk_file) for shard_name in sorted(manifest["shards"])
+            for chunk_file in manifest["shards"][shard_name]["chunks"]]
+
+
+def dataset_hash(dataset, cache_dir=None, block_size=1 << 20):
+    """
+    sha1 of the content of a dataset (see dataset_files). With cache_dir the hash is remembered in
+    cache_dir/hashes.json and only computed again when a file changes size or mtime.
+    """
+    files = [os.path.abspath(file_name) for file_name in dataset_files(dataset)]
+    signature = [[file_name, os.path.getsize(file_name), os.stat(file_name).st_mtime_ns] for file_name in files]
+    hashes_file = os.path.join(cache_dir, "hashes.json") if cache_dir is not None else None
+    known = (load_manifest(hashes_file) or {}) if hashes_file is not None else {}
+    name = os.path.abspath(dataset)
+    if name in known and known[name]["files"] == signature:
+        return known[name]["sha1"]
+
+    sha1 = hashlib.sha1()
+    for file_name in files:
+        with open(file_name, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha1.update(block)
+    if hashes_file is not None:
+        known[name] = {"files": signature, "sha1": sha1.hexdigest()}
+        save_manifest(known, hashes_file)
+    return sha1.hexdigest()
+
+
+def cache_key(**params):
+    # Short stable hash of the parameters (and dataset hash) a cached file depends on
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def cache_positions(dataset, sampler, out_file, block_size=10000):
+    """
+    Writes the positions of sampler (ops_dataset.EpochSampler), in the order of its permutation, from dataset
+    (MMapDataset or GameDataset) to a dataset of the same format: compact for compact datasets and move-list games
+    (replayed here once instead of at every gather), dense for dense datasets, whose policies may not be one-hot
+    (merge deduplication) and are kept as they are. Written under a temporary name so a cached file is always
+    complete.
+    """
+    positions = sampler.permutation
+    with DatasetWriter(out_file + ".tmp", chunk_size=block_size, compact=getattr(dataset, "compact", True)) as writer:
+        for b in range(0, len(positions), block_size):
+            states, policies, values, player_turn = dataset.gather(positions[b:b + block_size])
+            writer.add_game(states, policies, values, player_turn)
+    consolidate_chunks(writer.chunk_files, out_file + ".tmp.npz")
+    os.replace(out_file + ".tmp.npz", out_file)
+
@@ -1,149 +1,513 @@
+import hashlib
 import os
+import re
+import tarfile
+import zipfile
+from bisect import bisect_left
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
 import numpy as np
-from libgoban import IGame
 
+from ops import letter_to_number
+from ops_dataset import (MOVE_PLAYER_BIT, DatasetWriter, consolidate_chunks, load_manifest, replay_positions,
+                         save_games, save_manifest)
 
 
 # ------------------------------------------
 # ---------------- SGF File ----------------
 # ------------------------------------------
 
+# One token per match: a property value (with escaped characters), a
+# punctuation mark or a property identifier. Anything else is skipped.
+SGF_TOKEN = re.compile(r"\[([^\\\]]*(?:\\.[^\\\]]*)*)\]|([();])|([A-Za-z]+)", re.S)
+SGF_ESCAPE = re.compile(r"\\(?:\r\n?|\n|(.))", re.S)
+# A node made of a single move, and the first value not followed by one
+SGF_MOVE_NODE = re.compile(r"\s*;\s*[BW]\s*\[")
+SGF_MOVES_END = re.compile(r"\](?!;[BW]\[)")
+
+
+def _SGF_value_end(content, start):
+    # Index of the "]" closing the value opened before start, skipping escaped ones
+    end = content.find("]", start)
+    while end > 0:
+        backslashes = 0
+        while content[end - 1 - backslashes] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end
+        end = content.find("]", end + 1)
+    return len(content)
+
+
+def _SGF_parse_root(content):
+    # Properties of the root node, and the index where the next node (or variation) starts
+    header = {}
+    pos = content.find(";") + 1
+    if pos == 0:
+        return header, len(content)
+
+    # Fast path: the root ends at the next ";" unless a value contains one
+    end = content.find(";", pos)
+    if end < 0:
+        end = len(content)
+    root = content[pos:end]
+    if "\\" not in root and "(" not in root and ")" not in root and root.count("[") == root.count("]"):
+        ident = None
+        for prop in root.split("]")[:-1]:
+            name, _, value = prop.partition("[")
+            name = name.strip()
+            if name:
+                ident = name
+            header.setdefault(ident, []).append(value)
+        return header, end
+
+    ident = None
+    while True:
+        start = content.find("[", pos)
+        if start < 0:
+            return header, len(content)
+        between = content[pos:start]
+        for punct in ";()":
+            if punct in between:
+                return header, min(pos + i for i in map(between.find, ";()") if i >= 0)
+        between = between.strip()
+        if between:
+            ident = between
+        end = _SGF_value_end(content, start + 1)
+        value = content[start + 1:end]
+        if "\\" in value:
+            value = SGF_ESCAPE.sub(r"\1", value)
+        if ident is not None:
+            header.setdefault(ident, []).append(value)
+        pos = end + 1
+
+
+def _SGF_parse_main_line(content):
+    # Token by token, for the records the fast path of SGF_parse can't handle
+    moves = []
+    ident = None
+    for value, punct, name in SGF_TOKEN.findall(content):
+        if name:
+            ident = name
+        elif punct:
+            ident = None
+            if punct == ")":
+                # The first closing parenthesis ends the main line
+                break
+        elif ident == "B" or ident == "W":
+            if "\\" in value:
+                value = SGF_ESCAPE.sub(r"\1", value)
+            moves.append(ident + value)
+    return moves
+
+
+def _SGF_split_moves(run):
+    # Moves of a run of nodes holding a single move each, with string methods only. None if the run holds
+    # anything else.
+    if "\\" in run or "(" in run or ")" in run:
+        return None
+    for blank in ("\n", "\r", " ", "\t"):
+        if blank in run:
+            run = run.replace(blank, "")
+    num_nodes = run.count(";")
+    if not (run.count("[") == num_nodes == run.count("]") == run.count(";B[") + run.count(";W[")):
+        return None
+    return run.replace("[", "").replace("]", "").split(";")[1:]
+
+
+def SGF_parse(content, header_only=False):
+    """
+    Parses an SGF game record in a single pass.
+    :param content: the SGF text
+    :param header_only: stop after the root node
+    :return: (header, moves) where header maps the root node properties to their list of values and moves is the
+    main line as a list of color + value strings ("Bpd", "W" for a pass). Variations and anything after the first
+    game tree are ignored.
+    """
+    header, end = _SGF_parse_root(content)
+    moves = [color + value for color in ("B", "W") for value in header.get(color, [])]
+    if header_only:
+        return header, moves
+
+    body = content[end:]
+    # Fast path: a main line without variations made of single move nodes only
+    if "(" not in body and body.count(")") <= 1:
+        split = _SGF_split_moves(body.split(")", 1)[0])
+        if split is not None:
+            return header, moves + split
+    # Otherwise split the leading run of single move nodes (before territory properties, comments, variations...)
+    # and go token by token from there
+    if SGF_MOVE_NODE.match(body):
+        irregular = SGF_MOVES_END.search(body)
+        stop = irregular.end() if irregular else len(body)
+        split = _SGF_split_moves(body[:stop])
+        if split is not None:
+            moves += split
+            body = body[stop:]
+    moves += _SGF_parse_main_line(body)
+    return header, moves
+
+
+def SGF_file_read(file_name, header_only=False, block_size=4096):
+    with open(file_name, "r", encoding="utf-8", errors="replace") as fichier:
+        if not header_only:
+            return SGF_parse(fichier.read())
+        # Only read up to the end of the root node
+        content = ""
+        while True:
+            block = fichier.read(block_size)
+            content += block
+            header, end = _SGF_parse_root(content)
+            if end < len(content) or not block:
+                return SGF_parse(content[:end], header_only=True)
+
+
+def SGF_move_to_index(value, size):
+    # Empty value or "tt" (on boards up to 19x19) is a pass
+    if value == "" or (value == "tt" and size <= 19):
+        return size * size
+    return letter_to_number(value[0]) * size + letter_to_number(value[1])
+
+
+def SGF_legacy_tokens(content):
+    # Legacy tokenizer, kept as the baseline of the parser benchmark
+    content = content.replace("[]", '\n  \n').replace('[', '\n').replace(']', '\n').replace(';', '\n')
+    content = content.split("\n")
+    content = list(filter(lambda a: a != '' and a != ')' and a != '(', content))
+    return content
+
+
 def SGF_file_parser(file_name):
     with open(file_name, "r") as fichier:
-        content = fichier.read()
-        content = content.replace("[]", '\n  \n').replace('[', '\n').replace(']', '\n').replace(';', '\n')
-        content = content.split("\n")
-        content = list(filter(lambda a: a != '' and a != ')' and a != '(', content))
-    return content
+        return SGF_legacy_tokens(fichier.read())
 
 
-def SGF_file_to_dataset(file_name):
-    content = SGF_file_parser(file_name)
+def SGF_game(header, moves):
+    """
+    Parsed SGF game record (see SGF_parse) to a game of the move-list format.
+    :return: (size, komi, winner, setup, moves), see ops_dataset.save_games
+    """
+    size = int(header["SZ"][0]) if "SZ" in header else 19
+    handicap = int(header["HA"][0]) if "HA" in header else 0
+    komi = float(header["KM"][0]) if "KM" in header else 0.
+    winner = 2
+    # Result
+    if "RE" in header:
+        winner, _, _ = header["RE"][0].partition("+")
+        winner = 0 if winner == "B" else 1 if winner == "W" else 2
+    # Handicap moves
+    setup = []
+    for prop in ("AW", "AB"):
+        if prop in header:
+            for stone in header[prop][:handicap]:
+                setup += [letter_to_number(stone[0]) * size + letter_to_number(stone[1]), size * size]
+            setup.append(size * size)  # Necessary because it's up to white to play
+
+    moves = [SGF_move_to_index(move[1:], size) | (0 if move[0] == "B" else MOVE_PLAYER_BIT) for move in moves]
+    return size, komi, winner, setup, moves
+
+
+def SGF_file_to_game(file_name):
+    return SGF_game(*SGF_file_read(file_name))
+
+
+def SGF_game_to_dataset(game):
+    size, _, winner, setup, moves = game
+    states = replay_positions(size, setup, moves)
 
-    states = []
     policies = []
     values = []
     player_turn = []
+    for move in moves:
+        player = move >> 15
+        # Make policy
+        policy = np.zeros(size * size + 1)
+        policy[move & (MOVE_PLAYER_BIT - 1)] = 1
+        # Make value
+        value = 0 if winner == 2 else 1 if winner == player else -1
 
-    size = 19
-    handicap = 0
-    winner = 2
-    points_or_resign = ""
-
-    g = IGame(size)
-
-    g_old = np.full((1, size, size, 2), 0)
-    for i in range(len(content)):
-        elem = content[i]
-        # Board size
-        if elem == "SZ":
-            size = int(content[i + 1])
-            g = IGame(size)
-        # Handicap
-        elif elem == "HA":
-            handicap = int(content[i + 1])
-        elif elem == "KM":
-            komi = float(content[i + 1])
-            g.set_komi(komi)
-        # Result
-        elif elem == "RE":
-            splited = content[i + 1].split("+")
-            winner, points_or_resign = splited[0], splited[1]
-            winner = 0 if winner == "B" else 1 if winner == "W" else 2
-        # Handicap moves
-        elif elem == "AW" or elem == "AB":
-            for h in range(handicap):
-                x = letter_to_number(content[i + 1 + h][0])
-                y = letter_to_number(content[i + 1 + h][1])
-                g.play((x, y))
-                g.play(None)
-            g.play(None)  # Necessary because it's up to white to play
-        # g.display_goban()
-        # Moves
-        elif elem == "W" or elem == "B":
-            player = 0 if elem == "B" else 1
-            # Make state
-            # goban = goban_1D_to_goban_2D(g.goban(), size)
-            goban = g.raw_goban_split()
-            goban, g_old = goban_to_input_planes(goban, g_old, player, size)
-
-            # Make policy
-            policy = np.zeros(size * size + 1)
-            if content[i + 1] == '  ':
-                move = size * size
-            else:
-                x = letter_to_number(content[i + 1][0])
-                y = letter_to_number(content[i + 1][1])
-                move = x * size + y
-            policy[move] = 1
-            # Make value
-            value = 0 if winner == 2 else 1 if winner == player else -1
-
-            # Save data
-            states.append(goban)
-            policies.append(policy)
-            values.append(value)
-            player_turn.append(player)
-
-            # Play move
-            if move == size * size:
-                g.play(None)
-            else:
-                g.play((x, y))
-        # g.display_goban()
-
-    if points_or_resign == "Resign" or points_or_resign == "R":
-        g.resign(True if winner == 1 else False)
-    if not g.over():
-        g.play(None)
-        g.play(None)
-    """print(file_name)
-    print(str(winner) + " " + points_or_resign)
-    print(g.get_winner())"""
-
-    return states, policies, values, player_turn
-
-
-def SGF_folder_to_dataset(folder_name, out):
-    all_states = []
-    all_policies = []
-    all_values = []
-    all_turn = []
-
-    i = 0
-    for file_name in os.listdir(folder_name):
-        if file_name[-4:] == ".sgf":
-            if i % 100 == 0:
-                print(i)
-            i += 1
-            file_name = folder_name + file_name
-            states, policies, values, player_turn = SGF_file_to_dataset(file_name)
-            for state in states:
-                all_states.append(state)
-            for policy in policies:
-                all_policies.append(policy)
-            for value in values:
-                all_values.append(value)
-            for turn in player_turn:
-                all_turn.append(turn)
-
-    np.savez(out + "dataset",
-             states=all_states,
-             policies=all_policies,
-             values=all_values,
-             player_turn=all_turn)
-
-
-def SGF_folder_rule_filter(folder_name, rule_filter):
-    for file_name in os.listdir(folder_name):
-        if file_name[-4:] == ".sgf":
-            is_filter = True
-            file_name = folder_name + file_name
-            content = SGF_file_parser(file_name)
-            for i in range(len(content)):
-                elem = content[i]
-                if elem == "RU" and content[i + 1] == rule_filter:
-                    is_filter = False
-            if is_filter:
-                print("remove {}".format(file_name))
-                os.remove(file_name)
+        policies.append(policy)
+        values.append(value)
+        player_turn.append(player)
+
+    return list(states), policies, values, player_turn
+
+
+def SGF_file_to_dataset(file_name):
+    return SGF_game_to_dataset(SGF_file_to_game(file_name))
+
+
+def SGF_folder_files(folder_name):
+    # Sorted so that the dataset rows always come out in the same order
+    return [folder_name + file_name for file_name in sorted(os.listdir(folder_name))
+            if file_name[-4:] == ".sgf"]
+
+
+def SGF_files_to_dataset(file_names, writer, verbose=True):
+    for i, file_name in enumerate(file_names):
+        if verbose and i % 100 == 0:
+            print(i)
+        states, policies, values, player_turn = SGF_file_to_dataset(file_name)
+        writer.add_game(states, policies, values, player_turn)
+    return writer.close()
+
+
+def SGF_file_signature(file_name, use_hash=False):
+    stat = os.stat(file_name)
+    signature = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if use_hash:
+        with open(file_name, "rb") as f:
+            signature["sha1"] = hashlib.sha1(f.read()).hexdigest()
+    return signature
+
+
+def SGF_file_unchanged(file_name, signature):
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return False
+    if stat.st_size == signature["size"] and stat.st_mtime_ns == signature["mtime"]:
+        return True
+    # Touched or copied files are still the same game if their content is
+    return "sha1" in signature and SGF_file_signature(file_name, True)["sha1"] == signature["sha1"]
+
+
+def _SGF_shard_worker(task):
+    shard_prefix, file_names, chunk_size, compact, use_hash, verbose = task
+    # Signatures are taken before parsing so a file modified meanwhile is parsed again next time
+    signatures = {file_name: SGF_file_signature(file_name, use_hash) for file_name in file_names}
+    writer = DatasetWriter(shard_prefix, chunk_size, compact)
+    chunk_files = SGF_files_to_dataset(file_names, writer, verbose=verbose)
+    return shard_prefix, chunk_files, signatures, writer.num_positions
+
+
+def SGF_folder_to_games(folder_name, out, workers=1, include=None):
+    """
+    Parses the SGF files of folder_name (or of the include list) into out + "games.npz", the move-list format where
+    every game is stored once and positions are replayed when drawn (see ops_dataset.GameDataset).
+    folder_name can also be a zip or tar archive of SGF files.
+    """
+    if SGF_is_archive(folder_name):
+        contents = (content for _, content in SGF_archive_members(folder_name))
+        games = [game for games in _SGF_ordered_map(_SGF_contents_to_games, _SGF_batches(contents, 256), workers)
+                 for game in games]
+    else:
+        if include is None:
+            file_names = SGF_folder_files(folder_name)
+        else:
+            file_names = sorted(load_manifest(include)["files"])
+        if workers <= 1:
+            games = list(map(SGF_file_to_game, file_names))
+        else:
+            with Pool(workers) as pool:
+                games = pool.map(SGF_file_to_game, file_names, chunksize=max(1, len(file_names) // (workers * 16)))
+    save_games(games, out + "games.npz")
+    print("{} games, {} positions".format(len(games), sum(len(game[4]) for game in games)))
+
+
+def SGF_folder_to_dataset(folder_name, out, workers=1, chunk_size=50000, compact=False, shard_files=1000,
+                          use_hash=False, dedup=None, include=None):
+    """
+    Parses the SGF files of folder_name into out + "dataset.npz".
+    The games are parsed by shards of at most shard_files files (fewer so that every worker gets shards), each shard
+    written as chunks next to the dataset and recorded in out + "manifest.json" once complete. Later runs only parse the new or changed files (and the other
+    files of the shards they belong to), an interrupted run resumes after its last complete shard.
+    dedup ("drop" or "merge") removes the repeated positions from the dataset, see ops_dataset.dedup_chunks, and
+    writes what was removed to out + "dedup_report.json".
+    include is an include list written by SGF_folder_rule_filter, only its games are parsed instead of every file
+    of folder_name.
+    """
+    manifest_file = out + "manifest.json"
+    manifest = load_manifest(manifest_file)
+    if manifest is None:
+        manifest = {"compact": compact, "next_shard": 0, "shards": {}}
+    elif manifest["compact"] != compact:
+        raise ValueError("{} already holds a {} dataset".format(out, "compact" if manifest["compact"] else "dense"))
+
+    if include is None:
+        file_names = set(map(os.path.abspath, SGF_folder_files(folder_name)))
+    else:
+        file_names = set(map(os.path.abspath, load_manifest(include)["files"]))
+
+    # Shards with a changed, deleted or no longer included game are dropped and their other games parsed again
+    pending = set()
+    for shard_name in sorted(manifest["shards"]):
+        shard = manifest["shards"][shard_name]
+        if (all(file_name in file_names and SGF_file_unchanged(file_name, signature)
+                for file_name, signature in shard["files"].items()) and
+                all(os.path.exists(out + chunk_file) for chunk_file in shard["chunks"])):
+            continue
+        print("{} is out of date".format(shard_name))
+        pending.update(file_name for file_name in shard["files"] if file_name in file_names)
+        del manifest["shards"][shard_name]
+    processed = set(file_name for shard in manifest["shards"].values() for file_name in shard["files"])
+    pending.update(file_name for file_name in file_names if file_name not in processed)
+    pending = sorted(pending)
+
+    # Chunks of dropped shards or left by an interrupted run
+    chunk_files = set(chunk_file for shard in manifest["shards"].values() for chunk_file in shard["chunks"])
+    for file_name in os.listdir(out):
+        if file_name.startswith("dataset_shard_") and file_name not in chunk_files:
+            os.remove(out + file_name)
+
+    # Runs of pending files not interrupted by an already processed one, each cut into contiguous tasks of at most
+    # shard_files files, and into enough tasks to keep the workers busy. The shards of a resumed run then cover the
+    # same ranges of the sorted files as the lost ones, and the dataset is the one of an uninterrupted run
+    task_files = max(1, min(shard_files, -(-len(pending) // max(workers, 1))))
+    processed_sorted = sorted(processed)
+    runs = []
+    for file_name in pending:
+        if runs and bisect_left(processed_sorted, runs[-1][-1]) == bisect_left(processed_sorted, file_name):
+            runs[-1].append(file_name)
+        else:
+            runs.append([file_name])
+    slices = [run[bounds[i]:bounds[i + 1]] for run in runs
+              for bounds in [np.linspace(0, len(run), -(-len(run) // task_files) + 1).astype(int)]
+              for i in range(len(bounds) - 1)]
+    tasks = [(out + "dataset_shard_{:05d}".format(manifest["next_shard"] + i), files,
+              chunk_size, compact, use_hash, workers <= 1)
+             for i, files in enumerate(slices)]
+    manifest["next_shard"] += len(tasks)
+    save_manifest(manifest, manifest_file)
+    print("{} files to parse ({} already processed)".format(len(pending), len(processed)))
+
+    def record(result):
+        shard_prefix, shard_chunks, signatures, num_positions = result
+        shard_name = os.path.basename(shard_prefix)
+        manifest["shards"][shard_name] = {"chunks": [os.path.basename(chunk_file) for chunk_file in shard_chunks],
+                                          "files": signatures,
+                                          "positions": num_positions}
+        save_manifest(manifest, manifest_file)
+        return len(signatures)
+
+    done = 0
+    if workers <= 1:
+        for result in map(_SGF_shard_worker, tasks):
+            done += record(result)
+            print("{} / {} ({} positions in {})".format(done, len(pending), result[3], os.path.basename(result[0])))
+    elif tasks:
+        with Pool(min(workers, len(tasks))) as pool:
+            for result in pool.imap_unordered(_SGF_shard_worker, tasks):
+                done += record(result)
+                print("{} / {} ({} positions in {})".format(done, len(pending), result[3],
+                                                             os.path.basename(result[0])))
+
+    # Chunks are concatenated in the order of the first file of their shard, the result does not depend on the
+    # number of workers or on the runs the shards were parsed in
+    shard_names = sorted(manifest["shards"], key=lambda shard_name: min(manifest["shards"][shard_name]["files"]))
+    chunk_files = [out + chunk_file for shard_name in shard_names
+                   for chunk_file in manifest["shards"][shard_name]["chunks"]]
+    print("Consolidating {} chunks".format(len(chunk_files)))
+    report = consolidate_chunks(chunk_files, out + "dataset.npz", remove_chunks=False, dedup=dedup)
+    if report is not None:
+        save_manifest(report, out + "dedup_report.json")
+
+
+def _SGF_rule_worker(file_name):
+    header, _ = SGF_file_read(file_name, header_only=True)
+    return header.get("RU", [None])[0]
+
+
+def SGF_folder_rule_filter(folder_name, rule_filter, out_file, workers=1):
+    """
+    Scans the root node of the SGF files of folder_name and writes to out_file the include list of the games played
+    under rule_filter, the files themselves are left untouched. SGF_folder_to_dataset(include=out_file) then only
+    parses those games.
+    """
+    file_names = [os.path.abspath(file_name) for file_name in SGF_folder_files(folder_name)]
+    if workers <= 1:
+        rules = list(map(_SGF_rule_worker, file_names))
+    else:
+        with Pool(workers) as pool:
+            rules = pool.map(_SGF_rule_worker, file_names, chunksize=max(1, len(file_names) // (workers * 16)))
+
+    included = [file_name for file_name, rule in zip(file_names, rules) if rule == rule_filter]
+    save_manifest({"filter": {"RU": rule_filter}, "files": included}, out_file)
+    print("{} / {} files played under {} rules".format(len(included), len(file_names), rule_filter))
+    return included
+
+
+# ------------------------------------------
+# -------------- SGF archives --------------
+# ------------------------------------------
+
+SGF_ARCHIVES = (".zip", ".tar", ".tar.bz2", ".tbz2", ".tar.gz", ".tgz")
+
+
+def SGF_is_archive(path):
+    return os.path.isfile(path) and path.endswith(SGF_ARCHIVES)
+
+
+def SGF_archive_members(archive):
+    """
+    Yields the (name, content) of the SGF files of a zip or tar (possibly compressed) archive, in archive order,
+    without extracting it. Tar archives are read as a stream, in a single pass.
+    """
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zfile:
+            for info in zfile.infolist():
+                if not info.is_dir() and info.filename[-4:] == ".sgf":
+                    yield info.filename, zfile.read(info).decode("utf-8", errors="replace")
+    else:
+        with tarfile.open(archive, "r|*") as tfile:
+            for member in tfile:
+                if member.isfile() and member.name[-4:] == ".sgf":
+                    yield member.name, tfile.extractfile(member).read().decode("utf-8", errors="replace")
+
+
+def _SGF_batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def _SGF_ordered_map(function, tasks, workers):
+    # Ordered map over a process pool, tasks are only read a few at a time ahead of the workers
+    if workers <= 1:
+        yield from map(function, tasks)
+        return
+    with Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(function, (task,)))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def _SGF_contents_to_games(contents):
+    return [SGF_game(*SGF_parse(content)) for content in contents]
+
+
+def _SGF_archive_worker(task):
+    shard_prefix, contents, chunk_size, compact = task
+    writer = DatasetWriter(shard_prefix, chunk_size, compact)
+    for game in _SGF_contents_to_games(contents):
+        writer.add_game(*SGF_game_to_dataset(game))
+    return writer.close()
+
+
+def SGF_archive_to_dataset(archive, out, workers=1, chunk_size=50000, compact=False, shard_files=1000, dedup=None):
+    """
+    Parses the SGF files of a zip or tar archive into out + "dataset.npz" without extracting it.
+    The members are streamed by the main process and parsed by the workers in shards of shard_files games, the
+    dataset rows come out in archive order whatever the number of workers. This is the order of
+    SGF_folder_to_dataset on the extracted folder (sorted file names) only if the members are sorted in the archive.
+    """
+    contents = (content for _, content in SGF_archive_members(archive))
+    tasks = ((out + "archive_shard_{:05d}".format(i), batch, chunk_size, compact)
+             for i, batch in enumerate(_SGF_batches(contents, shard_files)))
+    chunk_files = []
+    for shard_chunks in _SGF_ordered_map(_SGF_archive_worker, tasks, workers):
+        chunk_files += shard_chunks
+        print("{} chunks".format(len(chunk_files)))
+
+    print("Consolidating {} chunks".format(len(chunk_files)))
+    report = consolidate_chunks(chunk_files, out + "dataset.npz", dedup=dedup)
+    if report is not None:
+        save_manifest(report, out + "dedup_report.json")
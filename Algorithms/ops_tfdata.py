@@ -0,0 +1,110 @@
+import numpy as np
+import tensorflow as tf
+
+import ops
+import ops_dataset
+
+
+# ------------------------------------------
+# ------------- TFRecord shards ------------
+# ------------------------------------------
+
+# One tf.train.Example per position, the rows of the compact format
+# states      bytes, the 4 board planes bit-packed (ops_dataset.pack_states)
+# move        int64, index of the played move (size * size for pass)
+# value       float
+# player_turn int64
+
+RECORD_FEATURES = {"states": tf.FixedLenFeature([], tf.string),
+                   "move": tf.FixedLenFeature([], tf.int64),
+                   "value": tf.FixedLenFeature([], tf.float32),
+                   "player_turn": tf.FixedLenFeature([], tf.int64)}
+
+
+def export_records(dataset, positions, prefix, shard_size=100000, block_size=10000):
+    """
+    Writes the rows of dataset (ops_dataset.MMapDataset or GameDataset) at positions to TFRecord shards of
+    shard_size positions, named prefix-<n>.tfrecord.
+    :return: the shard files
+    """
+    files = []
+    for shard, begin in enumerate(range(0, len(positions), shard_size)):
+        files.append("{}-{:05d}.tfrecord".format(prefix, shard))
+        with tf.python_io.TFRecordWriter(files[-1]) as writer:
+            for b in range(begin, min(begin + shard_size, len(positions)), block_size):
+                block = positions[b:min(b + block_size, begin + shard_size, len(positions))]
+                states, policies, values, player_turn = dataset.gather(block)
+                if states.dtype != np.uint8:
+                    states = ops_dataset.pack_states(states)
+                moves = policies if policies.ndim == 1 else np.argmax(policies, axis=1)
+                for i in range(len(block)):
+                    feature = {"states": tf.train.Feature(bytes_list=tf.train.BytesList(value=[states[i].tobytes()])),
+                               "move": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(moves[i])])),
+                               "value": tf.train.Feature(float_list=tf.train.FloatList(value=[float(values[i])])),
+                               "player_turn": tf.train.Feature(
+                                   int64_list=tf.train.Int64List(value=[int(player_turn[i])]))}
+                    writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+    return files
+
+
+# ------------------------------------------
+# ------------- Input pipeline -------------
+# ------------------------------------------
+
+def unpack_states(packed, board_size, planes=4):
+    # In-graph ops_dataset.unpack_states: [N, bytes] uint8 to [N, size, size, planes] uint8
+    shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+    bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(tf.expand_dims(packed, -1), shifts), 1)
+    bits = tf.reshape(bits, [tf.shape(packed)[0], -1])[:, :board_size * board_size * planes]
+    return tf.reshape(bits, [-1, board_size, board_size, planes])
+
+
+def dihedral_batch(states, policies, board_size, symmetries):
+    # In-graph ops.dihedral_batch, with the same permutation tables. policies [N, size * size + 1] or [N] moves
+    batch = tf.shape(states)[0]
+    rows = tf.tile(tf.expand_dims(tf.range(batch), 1), [1, board_size * board_size])
+    permutations = tf.gather(tf.constant(ops.dihedral_permutations(board_size), dtype=tf.int32), symmetries)
+    flat_states = tf.reshape(states, [batch, board_size * board_size, -1])
+    new_states = tf.reshape(tf.gather_nd(flat_states, tf.stack([rows, permutations], axis=-1)),
+                            [-1, board_size, board_size, int(states.shape[-1])])
+
+    if policies.shape.ndims == 1:
+        moves = tf.constant(ops.dihedral_move_permutations(board_size), dtype=policies.dtype)
+        return new_states, tf.gather_nd(moves, tf.stack([tf.cast(symmetries, policies.dtype), policies], axis=-1))
+
+    rows = tf.tile(tf.expand_dims(tf.range(batch), 1), [1, board_size * board_size + 1])
+    permutations = tf.gather(tf.constant(ops.dihedral_policy_permutations(board_size), dtype=tf.int32), symmetries)
+    new_policies = tf.gather_nd(policies, tf.stack([rows, permutations], axis=-1))
+    return new_states, new_policies
+
+
+def parse_batch(records, board_size, augment=True, sparse_policy=False):
+    # Serialized examples to the compact neural network inputs (see GoNeuralNetwork.input_feed)
+    # (N, size, size, 4) uint8 | (N,) | (N, size * size + 1), (N,) int64 moves when sparse_policy | (N, 1)
+    features = tf.parse_example(records, RECORD_FEATURES)
+    states = unpack_states(tf.decode_raw(features["states"], tf.uint8), board_size)
+    player_turn = tf.cast(features["player_turn"], tf.float32)
+    if sparse_policy:
+        policies = features["move"]
+    else:
+        policies = tf.one_hot(features["move"], board_size * board_size + 1, dtype=tf.float32)
+    values = tf.reshape(features["value"], [-1, 1])
+    if augment:
+        # A random symmetry per sample
+        symmetries = tf.random_uniform([tf.shape(states)[0]], 0, 8, dtype=tf.int32)
+        states, policies = dihedral_batch(states, policies, board_size, symmetries)
+    return states, player_turn, policies, values
+
+
+def records_dataset(files, board_size, batch_size, shuffle_buffer=50000, augment=True, prefetch=4,
+                    parallel_calls=4, sparse_policy=False):
+    """
+    tf.data pipeline over TFRecord shards: shards read interleaved in a random order, positions shuffled, batched,
+    parsed and augmented in the graph and prefetched. Repeats forever.
+    """
+    shards = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files)).repeat()
+    records = shards.interleave(tf.data.TFRecordDataset, cycle_length=min(len(files), 4), block_length=16)
+    records = records.shuffle(shuffle_buffer).batch(batch_size)
+    batches = records.map(lambda batch: parse_batch(batch, board_size, augment, sparse_policy),
+                          num_parallel_calls=parallel_calls)
+    return batches.prefetch(prefetch)
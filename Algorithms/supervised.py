@@ -1,43 +1,36 @@
+import json
+import os
 import random
 import numpy as np
 import ops
+import ops_dataset
+import ops_tfdata
 from statistics import mean
 from time import time
+from BatchPrefetcher import BatchPrefetcher
+from StepProfiler import StepProfiler
 
 
-def data_shuffling(states, policies, values):
-    temp = list(zip(states, policies, values))
-    random.shuffle(temp)
-    t_states, t_policies, t_values = zip(*temp)
-    t_states, t_policies, t_values = np.array(t_states), np.array(t_policies), np.array(t_values)
-    return t_states, t_policies, t_values
-
-
-def get_batch(states, policies, values, batch_size, len_train):
-    if batch_size == len_train:
-        batch_states, batch_policies, batch_values = states, policies, values
-    else:
-        idx = np.random.randint(low=0, high=len_train, size=batch_size)
-        batch_states, batch_policies, batch_values = states[idx], policies[idx], values[idx]
-        
-    return batch_states, batch_policies, batch_values
-    
-    
-def data_splitting(states, policies, values, len_dataset, test_ratio, k):
-    data = {}
-    b_split = int(len_dataset * test_ratio * k)
-    e_split = int((b_split + len_dataset * test_ratio) % len_dataset)
-    data["test_states"], data["test_policies"], data["test_values"] = states[b_split:e_split], policies[b_split:e_split], values[
-                                                                                              b_split:e_split]
-    data["train_states"] = np.concatenate([states[0:b_split], states[e_split:]])
-    data["train_policies"] = np.concatenate([policies[0:b_split], policies[e_split:]])
-    data["train_values"] = np.concatenate([values[0:b_split], values[e_split:]])
-
-    data["validation_states"] = data["test_states"]
-    data["validation_policies"] = data["test_policies"]
-    data["validation_values"] = data["test_values"]
-
-    return data
+def load_dataset(dataset):
+    # Rows are only read when drawn: move-list datasets are replayed, the others memory-mapped
+    if not os.path.isdir(dataset):
+        with np.load(dataset) as npzfile:
+            if ops_dataset.is_games(npzfile):
+                return ops_dataset.GameDataset(dataset)
+    return ops_dataset.MMapDataset(dataset)
+
+
+def evaluation_batches(dataset, positions, board_size, chunk_size=1024, sparse_policy=False):
+    # Evaluation set gathered and shaped one chunk at a time
+    for b in range(0, len(positions), chunk_size):
+        yield ops_dataset.expand_batch(*dataset.gather(positions[b:b + chunk_size]), board_size, sparse_policy)
+
+
+def print_evaluation(name, evaluation):
+    print("# {}:\npolicy accuracy = {:.4f}\nvalue  error    = {:.4f}\nloss            = {:.4f}".format(
+        name, evaluation["policy_accuracy"], evaluation["value_error"], evaluation["loss"]))
+    for k, accuracy in evaluation["top_k"].items():
+        print("top-{:<2} accuracy = {:.4f}".format(k, accuracy))
 
 
 def supervised_training(dataset, board_size, neural_network,
@@ -47,106 +40,113 @@ def supervised_training(dataset, board_size, neural_network,
                         batch_size=32,
                         data_size=25000,
                         k_fold=0,
-                        test_ratio=1 / 30 # From [Silver et al., 2016] Mastering the game of Go with deep neural networks and tree search
+                        test_ratio=1 / 30, # From [Silver et al., 2016] Mastering the game of Go with deep neural networks and tree search
+                        validation_ratio=0.,
+                        replacement=False,
+                        prefetch_workers=2,
+                        prefetch_queue=8,
+                        prefetch_processes=False,
+                        tf_data=False,
+                        records_prefix="train_records",
+                        eval_chunk_size=1024,
+                        top_k=(5,),
+                        sparse_policy=True,
+                        profile_file="training_profile.jsonl",
+                        profile_frequency=100,
+                        trace_frequency=0,
+                        trace_prefix="timeline",
+                        cache_dir=None,
+                        seed=0
                         ):
-    # Training parameters
-    k = k_fold  # k-fold cross validation
-    random.seed(0)
-
-    maxK = int(1 / test_ratio)
-    k = min(k, maxK - 1)
-
     # Load dataset
     print("Data loading")
-    npzfile = np.load(dataset)
-    t_states = npzfile['states']
-    t_policies = npzfile['policies']
-    t_values = npzfile['values']
-    player_turn = npzfile['player_turn']
-
-    # Subsample dataset if asked
-    if data_size > 0:
-        # pre-shuffle
-        print("(pre-shuffle)")
-        t_states, t_policies, t_values = data_shuffling(t_states, t_policies, t_values)
-
-        print("(subsample dataset)", data_size)
-        t_states = t_states[:data_size]
-        t_policies = t_policies[:data_size]
-        t_values = t_values[:data_size]
-        player_turn = player_turn[:data_size]
-    # (N, 1, 19, 19, 4) | (N, 362) | (N,)
-
-    # Shape states to neural network input shape
-    print("Data shaping")
-    tt_states = []
-    for i in range(len(t_states)):
-        planes = ops.add_player_feature_plane(t_states[i], board_size, player_turn[i])
-        tt_states.append(planes)
-    t_states = np.array(tt_states)
-    input_planes = t_states.shape[-1]
-    states, policies, values = ops.reshape_data_for_network(t_states, t_policies, t_values, board_size, input_planes)
-    # (N, 19, 19, 5) | (N, 362) | (N, 1)
+    dataset_path, dataset = dataset, load_dataset(dataset)
+    # Positions are indices into the dataset, rows are gathered (and shaped to the neural network input
+    # (N, 19, 19, 4) uint8 | (N,) moves, (N, 362) one-hot without sparse_policy | (N, 1) | (N,) turns) one batch at a
+    # time
 
-    # Shuffle
-    print("Data shuffling")
-    states, policies, values = data_shuffling(states, policies, values)
-
-    # Data splitting
+    # Shuffle and split, k-fold cross validation on the index permutation
     print("Data splitting")
-    len_dataset = len(values)
-    test_size = int(len_dataset * test_ratio)
-    if test_size != 0:
-        b_split = int(len_dataset * test_ratio * k)
-        e_split = int((b_split + len_dataset * test_ratio) % len_dataset)
-        test_states, test_policies, test_values = states[b_split:e_split], policies[b_split:e_split], values[
-                                                                                                      b_split:e_split]
-        train_states = np.concatenate([states[0:b_split], states[e_split:]])
-        train_policies = np.concatenate([policies[0:b_split], policies[e_split:]])
-        train_values = np.concatenate([values[0:b_split], values[e_split:]])
-
-        validation_states, validation_policies, validation_values = test_states, test_policies, test_values
-
-        """splitted_data = data_splitting(states, policies, values, len_dataset, test_ratio, k)
-        validation_states = splitted_data["validation_states"]
-        validation_policies = splitted_data["validation_policies"]
-        validation_values = splitted_data["validation_values"]
-        test_states, test_policies, test_values = splitted_data["test_states"], splitted_data["test_policies"], splitted_data["test_values"]
-        train_states, train_policies, train_values = splitted_data["train_states"], splitted_data["train_policies"], splitted_data["train_values"]"""
-
+    sampler = ops_dataset.EpochSampler(len(dataset), test_ratio, validation_ratio, k_fold, data_size, seed)
+    test_size = sampler.test_size
+    if cache_dir is not None:
+        # The sampled positions are written once, in the order of the permutation, to a dataset keyed by the dataset
+        # hash, number of positions, seed and format: the splits (any fold) are then contiguous ranges of it
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_params = {"dataset": ops_dataset.dataset_hash(dataset_path, cache_dir),
+                        "positions": len(sampler.permutation),
+                        "seed": seed,
+                        "compact": getattr(dataset, "compact", True)}
+        positions_file = os.path.join(cache_dir, "positions_{}.npz".format(ops_dataset.cache_key(**cache_params)))
+        if not os.path.exists(positions_file):
+            print("Caching the sampled positions")
+            ops_dataset.cache_positions(dataset, sampler, positions_file)
+        dataset = ops_dataset.MMapDataset(positions_file)
+        sampler.reindex()
+    # Held-out positions are streamed through the network in chunks of eval_chunk_size at each evaluation
     # Training
     print("Training")
-    print(train_states.shape)
-    print(train_policies.shape)
-    print(train_values.shape)
+    print(len(sampler))
 
     #neural_network.save_model()
-    len_train = train_states.shape[0]
     train_p_acc, train_v_loss, val_p_acc, val_v_loss, losses = [], [], [], [], []
     total_it = 0
 
+    if tf_data:
+        # The training set is written once to TFRecord shards, then read, shuffled, augmented and batched in the graph
+        if cache_dir is not None:
+            records_prefix = os.path.join(cache_dir, "records_{}".format(ops_dataset.cache_key(
+                test_ratio=test_ratio, validation_ratio=validation_ratio, k=sampler.k, **cache_params)))
+        if cache_dir is not None and os.path.exists(records_prefix + ".json"):
+            with open(records_prefix + ".json", "r") as f:
+                files = json.load(f)
+        else:
+            print("Writing the training records")
+            files = ops_tfdata.export_records(dataset, sampler.train_positions(np.arange(len(sampler))),
+                                              records_prefix)
+            with open(records_prefix + ".json", "w") as f:
+                json.dump(files, f)
+        neural_network.set_input_records(files, batch_size)
+        prefetch_workers = 0
+    # Batches are gathered and augmented (a random symmetry per sample) ahead of the training step
+    prefetcher = BatchPrefetcher(dataset, board_size, prefetch_workers, prefetch_queue, prefetch_processes,
+                                 sparse_policy)
+    # Per-step wait, gather, augmentation, session.run and metrics seconds, summarized every profile_frequency steps
+    # to profile_file, a Chrome trace of the session.run every trace_frequency steps. Gather and augmentation run in
+    # the prefetch workers, overlapping the steps: only the wait is on the training loop
+    profiler = StepProfiler(profile_file, profile_frequency, trace_frequency, trace_prefix)
+
     t0 = time()
     for ep in range(epoch):
         batch_loss, batch_p_acc, batch_v_err = [], [], []
-        for it in range(len_train // batch_size):
-            # Get batch
-            batch_states, batch_policies, batch_values = get_batch(train_states, train_policies, train_values, batch_size, len_train)
-            idx = np.random.randint(low=0, high=8)
-            #t01 = time()
-            batch_states, batch_policies, batch_values = ops.data_augmentation(batch_states, batch_policies, batch_values, board_size, input_planes, idx=idx)
-            #t11 = time()
-            #print("data augmentation %.3g" % (t11 - t01))
-
+        t_ep = time()
+        if tf_data:
+            batches = [None] * sampler.num_batches(batch_size)
+        else:
+            tasks = ((positions, np.random.randint(low=0, high=8, size=len(positions)))
+                     for positions in sampler.epoch(batch_size, replacement))
+            batches = prefetcher.epoch(tasks)
+        profiler.start()
+        for batch in batches:
             # Train model on this batch
-            #t02 = time()
-            loss, p_acc, v_err = neural_network.train(batch_states, batch_policies, batch_values, total_it)
-            #t12 = time()
-            #print("train %.3g" % (t12 - t02))
+            trace_file = profiler.trace_file(total_it)
+            with profiler.stage("session_run"):
+                if tf_data:
+                    loss, p_acc, v_err = neural_network.train_from_pipeline(total_it, trace_file=trace_file)
+                else:
+                    states, policies, values, player_turn = batch
+                    loss, p_acc, v_err = neural_network.train(states, policies, values, total_it, player_turn,
+                                                              trace_file=trace_file)
+            with profiler.stage("metrics"):
+                batch_loss.append(loss)
+                batch_p_acc.append(p_acc)
+                batch_v_err.append(v_err)
+            if not tf_data:
+                for stage, seconds in prefetcher.last_timings.items():
+                    profiler.add(stage, seconds)
+            profiler.end_step(total_it)
             total_it += 1
-            batch_loss.append(loss)
-            batch_p_acc.append(p_acc)
-            batch_v_err.append(v_err)
-    
+
         # Print results
         t1 = time()
         p_acc, v_err, loss = mean(batch_p_acc), mean(batch_v_err), mean(batch_loss)
@@ -155,15 +155,17 @@ def supervised_training(dataset, board_size, neural_network,
         print("# Epoch {} / {}: (%.3g sec) \nloss = {}".format(ep, epoch, loss) % (t1 - t0))
         print("##############")
         print("# TRAINING  :\npolicy accuracy = {:.4f}\nvalue  error    = {:.4f}".format(p_acc, v_err))
+        if not tf_data:
+            print("input wait      = {:.3g} sec ({:.1%} of the epoch)".format(prefetcher.wait_time,
+                                                                              prefetcher.wait_time / (t1 - t_ep)))
 
         if test_size != 0:
-            vali_p_acc, vali_v_err, _, _ = neural_network.feed_forward_accuracies(validation_states,
-                                                                                    validation_policies,
-                                                                                    validation_values,
-                                                                                    ep)
+            validation = neural_network.evaluate(evaluation_batches(dataset, sampler.validation_positions(),
+                                                                    board_size, eval_chunk_size, sparse_policy),
+                                                 ep, top_k)
+            vali_p_acc, vali_v_err = validation["policy_accuracy"], validation["value_error"]
             print("##############")
-            print("# VALIDATION:\npolicy accuracy = {:.4f}\nvalue  error    = {:.4f}".format(vali_p_acc,
-                                                                                             vali_v_err))
+            print_evaluation("VALIDATION", validation)
             print("#####################")
             val_p_acc.append(vali_p_acc)
             val_v_loss.append(vali_v_err)
@@ -181,10 +183,13 @@ def supervised_training(dataset, board_size, neural_network,
         """if ep % save_frequency == 0:
             neural_network.save_model(False)"""
 
+    prefetcher.close()
+    profiler.close()
     print("Optimization Finished!")
-    test_p_acc, test_v_err, _, _ = neural_network.feed_forward_accuracies(test_states, test_policies,
-                                                                          test_values, 0)
-    print("TEST      :\npolicy accuracy = {:.4f}\nvalue  error    = {:.4f}".format(test_p_acc, test_v_err))
+    if test_size != 0:
+        test = neural_network.evaluate(evaluation_batches(dataset, sampler.test_positions(), board_size,
+                                                          eval_chunk_size, sparse_policy), 0, top_k)
+        print_evaluation("TEST", test)
 
 
 